@@ -0,0 +1,150 @@
+"""A cheap local appraisal for low-signal messages like "ok" or "lol", so they don't need an LLM call."""
+
+import re
+import threading
+
+from const import APPRAISAL_LOCAL_MAX_WORDS
+
+# Acknowledgements and reactions that carry little on their own, each with how it reflects on the conversation:
+# 0 is neutral, positive and negative are mild good or bad news for the AI, "thanks" praises the AI's action.
+# Answers like "yes" and "no" are left out, since what they mean depends on the question,
+# and so are content words like pronouns or "love", which only appear in messages that say something.
+LOW_SIGNAL_WORDS = {
+	**dict.fromkeys(
+		"ok okay k kk alright sure yeah yea yep yup hmm hm mhm uh um ah oh "
+		"hi hello hey yo bye cya gn gm np idk".split(),
+		0
+	),
+	**dict.fromkeys(
+		"lol lmao lmfao rofl haha hahaha hehe xd nice cool great awesome wow yay "
+		"amazing perfect neat".split(),
+		1
+	),
+	**dict.fromkeys("ugh meh whatever boring sigh ew eh".split(), -1),
+	**dict.fromkeys("thanks thx ty tysm".split(), "thanks")
+}
+# These flip the meaning of whatever follows, so a message with one always goes to the LLM
+NEGATORS = {"not", "no", "never", "dont", "don't", "isnt", "isn't", "wasnt", "wasn't", "cant", "can't", "nah", "nope"}
+
+EMOJI_RE = re.compile("[\U0001F300-\U0001FAFF☀-➿]")
+POSITIVE_EMOJI = set("😀😃😄😁😆😊🙂😍🥰😂🤣👍❤💕✨🎉😎😉")
+NEGATIVE_EMOJI = set("😞😔😢😭😠😡👎💔😒🙄😩😫")
+
+EVENT_DESIRABILITY = 15
+THANKS_PRAISEWORTHINESS = 20
+
+
+def _empty_appraisal():
+	return {
+		"events": {
+			"self": {"event": None, "is_prospective": False, "desirability": 0},
+			"other": {"event": None, "desirability": 0}
+		},
+		"actions": {
+			"self": {"action": None, "praiseworthiness": 0},
+			"other": {"action": None, "praiseworthiness": 0}
+		}
+	}
+
+
+def quick_appraisal(text):
+	"""Appraises a short message locally, in the format of APPRAISAL_SCHEMA.
+	Returns the appraisal and a confidence from 0 to 1, which is the fraction of emojis it knows the tone of.
+	Messages that are too long, or that have a negator or any word outside the lexicon,
+	get no appraisal and a confidence of 0."""
+	words = re.findall(r"[a-z']+", text.lower())
+	emojis = EMOJI_RE.findall(text)
+	num_tokens = len(words) + len(emojis)
+	if not num_tokens:
+		# Only punctuation, like "?" or "..."
+		return _empty_appraisal(), 1.0 if text.strip() else 0.0
+	if len(words) > APPRAISAL_LOCAL_MAX_WORDS:
+		return None, 0.0
+
+	known = len(words)
+	sentiment = 0
+	thanked = False
+	for word in words:
+		value = LOW_SIGNAL_WORDS.get(word)
+		if value is None or word in NEGATORS:
+			return None, 0.0
+		if value == "thanks":
+			thanked = True
+		else:
+			sentiment += value
+	for emoji in emojis:
+		if emoji in POSITIVE_EMOJI:
+			known += 1
+			sentiment += 1
+		elif emoji in NEGATIVE_EMOJI:
+			known += 1
+			sentiment -= 1
+
+	appraisal = _empty_appraisal()
+	if sentiment:
+		appraisal["events"]["self"] = {
+			"event": "The user reacted " + ("positively" if sentiment > 0 else "negatively"),
+			"is_prospective": False,
+			"desirability": EVENT_DESIRABILITY if sentiment > 0 else -EVENT_DESIRABILITY
+		}
+	if thanked:
+		appraisal["actions"]["self"] = {
+			"action": "Helping the user, who thanked me for it",
+			"praiseworthiness": THANKS_PRAISEWORTHINESS
+		}
+	return appraisal, known / num_tokens
+
+
+def get_dominant_emotion(emotions):
+	"""Returns the name of the strongest appraised emotion that would be noticeable, or None"""
+	for emotion, intensity in emotions:
+		if intensity >= 0.1:
+			return emotion
+	return None
+
+
+class AppraisalStats:
+	"""Counts how often appraisal escalates to the LLM, and how often the local tier agrees with it
+	on the messages that are appraised by both for comparison"""
+
+	def __init__(self):
+		self.local = 0
+		self.escalated = 0
+		self.shadowed = 0
+		self.agreed = 0
+		self.lock = threading.Lock()
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state["lock"]
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.lock = threading.Lock()
+
+	def record(self, escalated):
+		"""Records which tier appraised a message"""
+		with self.lock:
+			if escalated:
+				self.escalated += 1
+			else:
+				self.local += 1
+
+	def record_comparison(self, local_emotions, llm_emotions):
+		"""Records whether both tiers found the same dominant emotion for a message"""
+		with self.lock:
+			self.shadowed += 1
+			self.agreed += int(get_dominant_emotion(local_emotions) == get_dominant_emotion(llm_emotions))
+
+	def get_summary(self):
+		"""Returns the escalation rate and the agreement rate, or None if nothing has been appraised"""
+		total = self.local + self.escalated
+		if not total:
+			return None
+		return {
+			"appraisals": total,
+			"escalation_rate": self.escalated / total,
+			"compared": self.shadowed,
+			"agreement": self.agreed / self.shadowed if self.shadowed else None
+		}
@@ -1,6 +1,44 @@
 """The system that manages the beliefs of the AI."""
 
-from llm import MistralLLM
+import math
+import heapq
+import threading
+
+import numpy as np
+
+from llm import MistralLLM, mistral_embed_texts
+from const import (
+	BELIEF_SIMILARITY_THRESHOLD,
+	BELIEF_SOURCE_SIMILARITY_THRESHOLD,
+	BELIEF_QUEUE_SIZE,
+	BELIEF_HALF_LIFE,
+	BELIEF_IMPORTANCE_WEIGHT
+)
+
+# A belief's half-life is BELIEF_HALF_LIFE * (1 + 3 * importance^2), so dI/dt = -k * I / (1 + 3I^2).
+# Separating variables gives ln(I) + 1.5I^2 = C - k*t, so this potential falls at a constant rate.
+BELIEF_DECAY_RATE = math.log(2) / BELIEF_HALF_LIFE
+MIN_IMPORTANCE = 1e-12
+
+
+def get_decay_potential(importance):
+	"""Returns the decay potential ln(I) + 1.5I^2 of an importance"""
+	importance = max(importance, MIN_IMPORTANCE)
+	return math.log(importance) + 1.5 * importance**2
+
+
+def get_importance_from_potential(potential):
+	"""Inverts the decay potential, solving for u = ln(I) with Newton's method"""
+	potential = np.asarray(potential, dtype=np.float64)
+	# The function is convex, so starting above the root converges monotonically
+	u = np.where(potential < 0, potential, 0.5 * np.log(np.maximum(potential, 1.5) / 1.5))
+	for _ in range(50):
+		exp = np.exp(2 * u)
+		step = (u + 1.5 * exp - potential) / (1 + 3 * exp)
+		u = u - step
+		if np.all(np.abs(step) < 1e-12):
+			break
+	return np.exp(u)
 
 BELIEF_SYSTEM_PROMPT = """Generate a belief that would arise, given the memory.
 The belief should be a sentence written from {name}'s perspective.
@@ -46,18 +84,182 @@ Memory:
 ```
 Belief: """
 
+class BeliefWorker:
+	"""Forms beliefs from memories on a background thread.
+	Memories waiting to be processed are coalesced, and the least important one is dropped when the queue is full."""
+
+	def __init__(self, belief_system, pending=None, max_pending=BELIEF_QUEUE_SIZE):
+		self.belief_system = belief_system
+		self.max_pending = max_pending
+		self.pending = dict(pending or {})  # Memory content -> importance
+		self.busy = False
+		self.cond = threading.Condition()
+		self.thread = None
+
+	def _ensure_running(self):
+		if self.thread is None or not self.thread.is_alive():
+			self.thread = threading.Thread(target=self._run, daemon=True)
+			self.thread.start()
+
+	def submit(self, memory, importance):
+		"""Queues a memory to form a belief from. Returns False if it was dropped."""
+		with self.cond:
+			if memory in self.pending:
+				self.pending[memory] = max(self.pending[memory], importance)
+			elif len(self.pending) >= self.max_pending:
+				weakest = min(self.pending, key=self.pending.get)
+				if self.pending[weakest] >= importance:
+					return False
+				del self.pending[weakest]
+				self.pending[memory] = importance
+			else:
+				self.pending[memory] = importance
+			self._ensure_running()
+			self.cond.notify()
+		return True
+
+	def get_pending(self):
+		"""Returns the memories still waiting to be processed, with their importance"""
+		with self.cond:
+			return dict(self.pending)
+
+	def flush(self, timeout=None):
+		"""Waits until all queued memories have been processed. Returns False on timeout."""
+		with self.cond:
+			if self.pending:
+				self._ensure_running()
+			return self.cond.wait_for(lambda: not self.pending and not self.busy, timeout)
+
+	def _run(self):
+		while True:
+			with self.cond:
+				self.cond.wait_for(lambda: self.pending)
+				batch = list(self.pending.items())
+				self.pending.clear()
+				self.busy = True
+			try:
+				self.belief_system.form_beliefs(batch)
+			except Exception:  # pylint: disable=W0718
+				# Beliefs are a best effort, so a failed batch is dropped
+				pass
+			finally:
+				with self.cond:
+					self.busy = False
+					self.cond.notify_all()
+
+
 class BeliefSystem:
 	"""The system that manages the AI's beliefs"""
 	model = MistralLLM("mistral-medium-latest")
-	max_beliefs = 12
+	max_beliefs = 256
 
 	def __init__(self, config):
 		self.config = config
-		self.beliefs = []
+		# Min-heap of (potential, seq, belief), so the least important belief is always at the top.
+		# Decay lowers every importance together without changing their order, so it only needs a clock.
+		self.heap = []
+		self.seq = 0
+		self.elapsed = 0.0
+		self.index = {}
+		self.lock = threading.RLock()
+		self.worker = BeliefWorker(self)
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state["lock"]
+		del state["worker"]
+		del state["index"]
+		state["pending"] = self.worker.get_pending()
+		return state
+
+	def __setstate__(self, state):
+		pending = state.pop("pending", {})
+		beliefs = state.pop("beliefs", None)
+		self.__dict__.update(state)
+		self.index = {}
+		self.lock = threading.RLock()
+		self.worker = BeliefWorker(self, pending)
+		if beliefs is not None:
+			# Saved before beliefs were kept in a heap
+			self.heap = []
+			self.seq = 0
+			self.elapsed = 0.0
+			self.set_beliefs(beliefs)
+		if pending:
+			# Resume forming beliefs from the memories that were still waiting when this was saved
+			with self.worker.cond:
+				self.worker._ensure_running()  # pylint: disable=W0212
+
+	def _get_potential(self, importance):
+		# The potential a belief with this importance right now would have at elapsed time 0
+		return get_decay_potential(importance) + BELIEF_DECAY_RATE * self.elapsed
+
+	def get_importance(self, belief):
+		"""Returns the current importance of a belief"""
+		return float(get_importance_from_potential(belief["potential"] - BELIEF_DECAY_RATE * self.elapsed))
+
+	def get_ranked_beliefs(self):
+		"""Returns the belief dicts, from most to least important"""
+		with self.lock:
+			return [belief for _, _, belief in sorted(self.heap, reverse=True)]
+
+	def set_beliefs(self, beliefs):
+		"""Replaces the beliefs. Each belief needs either a potential or a current importance."""
+		with self.lock:
+			heap = []
+			for belief in beliefs:
+				belief = dict(belief)
+				importance = belief.pop("importance", None)
+				if belief.get("potential") is None:
+					belief["potential"] = self._get_potential(importance)
+				heap.append((belief["potential"], self.seq, belief))
+				self.seq += 1
+			heapq.heapify(heap)
+			while len(heap) > self.max_beliefs:
+				heapq.heappop(heap)
+			self.heap = heap
+			self.index = {}
 
 	def get_beliefs(self):
 		"""Returns a list of the AI's current beliefs"""
-		return [belief["content"] for belief in self.beliefs]
+		return [belief["content"] for belief in self.get_ranked_beliefs()]
+
+	def get_relevant_beliefs(self, query_vec, k, token_budget):
+		"""Returns up to k beliefs ranked by relevance to the query embedding, within a token budget.
+		Without a query, the most important beliefs are returned instead."""
+		with self.lock:
+			beliefs, matrix = self._get_index("embedding")
+			if not beliefs:
+				return []
+			potentials = np.array([b["potential"] for b in beliefs])
+			importances = get_importance_from_potential(potentials - BELIEF_DECAY_RATE * self.elapsed)
+			scores = BELIEF_IMPORTANCE_WEIGHT * importances
+			if query_vec is not None and matrix is not None:
+				scores = scores + matrix @ (query_vec / np.linalg.norm(query_vec))
+		relevant = []
+		tokens = 0
+		for i in np.argsort(-scores):
+			content = beliefs[i]["content"]
+			cost = len(content) // 4 + 2  # Rough token estimate, including the bullet
+			if tokens + cost > token_budget:
+				continue
+			relevant.append(content)
+			tokens += cost
+			if len(relevant) >= k:
+				break
+		return relevant
+
+	def submit_memory(self, memory, importance):
+		"""Queues a memory to form a new belief from in the background"""
+		return self.worker.submit(memory, importance)
+
+	def get_pending(self):
+		"""Returns the memories waiting to form beliefs, with their importance"""
+		return self.worker.get_pending()
+
+	def flush(self, timeout=None):
+		"""Waits for queued beliefs to finish forming. Returns False on timeout."""
+		return self.worker.flush(timeout)
 
 	def _generate_belief(self, memory, importance):
 		name = self.config.name
@@ -89,42 +291,94 @@ class BeliefSystem:
 		belief["importance"] = (belief["importance"] + importance) / 2
 		return belief
 
-	def _has_belief(self, belief):
-		return any(b["content"] == belief["content"] for b in self.beliefs)
-
-	def _add_belief(self, belief):
-		if len(self.beliefs) >= self.max_beliefs:
-			min_importance = min(b["importance"] for b in self.beliefs)
-			if belief["importance"] < min_importance:
-				return False
-			
-		self.beliefs.append(belief)
-		self.beliefs.sort(key=lambda b: b["importance"], reverse=True)
-		if len(self.beliefs) > self.max_beliefs:  # Keep most important beliefs
-			self.beliefs = self.beliefs[:self.max_beliefs]
+	def _get_index(self, key):
+		# The beliefs and a matrix of their unit-normalized embeddings under the key, rebuilt only when beliefs change.
+		# Beliefs without an embedding get a zero row.
+		if key not in self.index:
+			beliefs = [b for _, _, b in self.heap]
+			vecs = [b.get(key) for b in beliefs]
+			dims = [len(vec) for vec in vecs if vec is not None]
+			matrix = None
+			if dims:
+				matrix = np.zeros((len(beliefs), dims[0]))
+				for i, vec in enumerate(vecs):
+					if vec is not None:
+						matrix[i] = vec / np.linalg.norm(vec)
+			self.index[key] = (beliefs, matrix)
+		return self.index[key]
+
+	def _find_similar(self, vec, key, threshold):
+		# Returns the belief whose embedding under the key is most similar to vec, if it is above the threshold
+		beliefs, matrix = self._get_index(key)
+		if vec is None or matrix is None:
+			return None
+		sims = matrix @ (vec / np.linalg.norm(vec))
+		best = int(np.argmax(sims))
+		return beliefs[best] if sims[best] >= threshold else None
+
+	def _merge_belief(self, belief, importance):
+		# Repeated evidence for a belief makes it more important
+		merged = 1 - (1 - self.get_importance(belief)) * (1 - importance)
+		belief["potential"] = self._get_potential(merged)
+		heap = [(b["potential"], seq, b) for _, seq, b in self.heap]
+		heapq.heapify(heap)
+		self.heap = heap
+		self.index = {}
+
+	def _add_belief(self, belief, importance):
+		belief["potential"] = self._get_potential(importance)
+		entry = (belief["potential"], self.seq, belief)
+		self.seq += 1
+		if len(self.heap) < self.max_beliefs:
+			heapq.heappush(self.heap, entry)
+		elif entry > self.heap[0]:  # Keep most important beliefs
+			heapq.heapreplace(self.heap, entry)
+		else:
+			return False
+		self.index = {}
 		return True
 
+	def _apply_belief(self, belief):
+		importance = belief.pop("importance")
+		with self.lock:
+			duplicate = self._find_similar(belief["embedding"], "embedding", BELIEF_SIMILARITY_THRESHOLD)
+			if duplicate is not None:
+				self._merge_belief(duplicate, importance)
+			else:
+				self._add_belief(belief, importance)
+
+	def form_beliefs(self, memories):
+		"""Forms beliefs from a list of (memory, importance) pairs, embedding them in batches"""
+		memory_vecs = np.array(mistral_embed_texts([memory for memory, _ in memories]))
+		generated = []
+		for (memory, importance), memory_vec in zip(memories, memory_vecs):
+			# Memories close to one that already formed a belief just reinforce that belief
+			with self.lock:
+				source = self._find_similar(memory_vec, "source_embedding", BELIEF_SOURCE_SIMILARITY_THRESHOLD)
+				if source is not None:
+					self._merge_belief(source, importance)
+					continue
+			try:
+				belief = self._generate_belief(memory, importance)
+			except Exception:  # pylint: disable=W0718
+				continue
+			belief["source_embedding"] = memory_vec
+			generated.append(belief)
+		if not generated:
+			return
+		belief_vecs = mistral_embed_texts([belief["content"] for belief in generated])
+		for belief, belief_vec in zip(generated, belief_vecs):
+			belief["embedding"] = np.array(belief_vec)
+			self._apply_belief(belief)
+
 	def generate_new_belief(self, memory, importance):
 		"""Generates a new belief given a memory."""
 		try:
-			belief = self._generate_belief(memory, importance)
-		except Exception as e:
-			return
-		if not self._has_belief(belief):
-			self._add_belief(belief)
-
-	def _tick(self, dt):
-		for belief in self.beliefs:
-			# Important memories decay slower
-			half_life = 20 * 86400 * (1 + belief["importance"]**2 * 3)
-			decay_factor = 0.5 ** (dt / half_life)
-			belief["importance"] *= decay_factor
+			self.form_beliefs([(memory, importance)])
+		except Exception:  # pylint: disable=W0718
+			pass
 
 	def tick(self, delta):
 		"""Ticks the belief system"""
-		subtick = max(1, min(delta / 10, 10000))
-		while delta > 0:
-			subt = min(delta, subtick)
-			self._tick(subt)
-			delta -= subt
-		
+		with self.lock:
+			self.elapsed += delta
@@ -0,0 +1,848 @@
+"""Benchmarks for the memory system. These run offline on synthetic memories."""
+
+import io
+import os
+import sys
+import copy
+import json
+import time
+import random
+import tarfile
+import argparse
+import platform
+import contextlib
+import subprocess
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import clock
+from const import LSH_NUM_BITS, LSH_VEC_DIM, MOOD_HALF_LIFE
+from emotion_system import Emotion
+from memory_system import (
+	Memory,
+	LSHMemory,
+	LongTermMemory,
+	RetrievalContext,
+	get_recency_factors,
+	weighted_sample
+)
+from storage import SQLiteStore
+from transaction import Transaction
+from utils import (
+	conversation_to_string,
+	format_memories_to_string,
+	time_since_last_message_string
+)
+
+
+def _memories_from_embeddings(embeddings, rng):
+	num_memories = len(embeddings)
+	ages = rng.exponential(scale=7 * 86400, size=num_memories)
+	strengths = rng.uniform(1.0, 5.5, size=num_memories)
+	now = datetime.now()
+	memories = []
+	for i in range(num_memories):
+		memory = Memory(f"Synthetic memory #{i}", strength=float(strengths[i]))
+		memory.timestamp = memory.last_accessed = now - timedelta(seconds=float(ages[i]))
+		memory.embedding = embeddings[i]
+		memories.append(memory)
+	return memories
+
+
+def _normalize(vecs):
+	return vecs / np.linalg.norm(vecs, axis=-1, keepdims=True)
+
+
+def make_memories(num_memories, embed_size=LSH_VEC_DIM, seed=0):
+	"""Creates synthetic memories with deterministic embeddings and ages"""
+	rng = np.random.default_rng(seed)
+	embeddings = _normalize(rng.normal(size=(num_memories, embed_size)))
+	return _memories_from_embeddings(embeddings, rng)
+
+
+def make_corpus(
+	num_memories,
+	embed_size=LSH_VEC_DIM,
+	num_topics=50,
+	topic_spread=0.6,
+	duplicate_rate=0.05,
+	seed=0
+):
+	"""Creates a deterministic synthetic corpus where memories are clustered around topics,
+	and a fraction of them are near-duplicates of earlier memories"""
+	rng = np.random.default_rng(seed)
+	topics = _normalize(rng.normal(size=(num_topics, embed_size)))
+	labels = rng.integers(num_topics, size=num_memories)
+	noise = rng.normal(size=(num_memories, embed_size)) / np.sqrt(embed_size)
+	embeddings = _normalize(topics[labels] + topic_spread * noise)
+
+	num_duplicates = int(num_memories * duplicate_rate)
+	if num_duplicates and num_memories > 1:
+		targets = rng.choice(np.arange(1, num_memories), size=num_duplicates, replace=False)
+		sources = rng.integers(targets)
+		jitter = 0.05 * rng.normal(size=(num_duplicates, embed_size)) / np.sqrt(embed_size)
+		embeddings[targets] = _normalize(embeddings[sources] + jitter)
+	return _memories_from_embeddings(embeddings, rng), topics
+
+
+def make_queries(memories, num_queries, seed=1):
+	"""Creates queries near randomly chosen memories. Returns a RetrievalContext with
+	the query embeddings already filled in, so retrieval doesn't call the API."""
+	rng = np.random.default_rng(seed)
+	context = RetrievalContext()
+	queries = []
+	embed_size = len(memories[0].embedding)
+	for i, idx in enumerate(rng.integers(len(memories), size=num_queries)):
+		query = f"Synthetic query #{i}"
+		noise = 0.3 * rng.normal(size=embed_size) / np.sqrt(embed_size)
+		context.embeddings[query] = _normalize(memories[idx].embedding + noise)
+		queries.append(query)
+	return queries, context
+
+
+class ExactMemory:
+	"""Reference backend that scores every memory on retrieval. Used as ground truth for recall@k."""
+
+	def __init__(self):
+		self.memory_ids = {}
+		self.count = 0
+		self.version = 0
+
+	def add_memory(self, memory):
+		"""Adds a memory"""
+		self.memory_ids[memory.id] = (memory, 0)
+		self.count = len(self.memory_ids)
+		self.version += 1
+
+	def delete_memory(self, memory):
+		"""Removes a memory"""
+		if self.memory_ids.pop(memory.id, None) is not None:
+			self.count = len(self.memory_ids)
+			self.version += 1
+
+	def get_memories(self):
+		"""Gets all memories as a list"""
+		return [memory for memory, _ in self.memory_ids.values()]
+
+	def retrieve(self, query, k, remove=False, context=None, start=None, end=None):
+		"""Gets the top K memories by the same score LSHMemory uses, over all memories"""
+		memories = self.get_memories()
+		if start is not None or end is not None:
+			lo = start or datetime.min
+			hi = end or datetime.max
+			memories = [mem for mem in memories if lo <= mem.timestamp < hi]
+		if not memories:
+			return []
+		query_vec = context.embed(query)
+		vecs = np.stack([mem.embedding for mem in memories])
+		sim_vals = vecs @ query_vec / (np.linalg.norm(query_vec) * np.linalg.norm(vecs, axis=1))
+		scores = sim_vals + 0.5 * get_recency_factors(memories)
+		k = min(k, len(memories))
+		idx = np.argpartition(scores, -k)[-k:]
+		idx = idx[np.argsort(scores[idx])[::-1]]
+		retrieved = [memories[i] for i in idx]
+		if remove:
+			for mem in retrieved:
+				self.delete_memory(mem)
+		return retrieved
+
+	def recall_random(self, remove=False, k=5):
+		"""Recalls a random subset of memories, weighted by recency"""
+		memories = self.get_memories()
+		if not memories:
+			return []
+		recalled = [memories[i] for i in weighted_sample(get_recency_factors(memories), k)]
+		if remove:
+			for mem in recalled:
+				self.delete_memory(mem)
+		return recalled
+
+
+BACKENDS = {
+	"lsh": lambda embed_size: LSHMemory(LSH_NUM_BITS, embed_size),
+	"exact": lambda embed_size: ExactMemory()
+}
+
+
+def _legacy_recall_random(lsh):
+	# The per-bucket sampling loop that recall_random used to run
+	recalled = []
+	weights = []
+	for bucket in lsh.table.values():
+		if not bucket:
+			continue
+		sample = random.sample(bucket.memories, min(6, len(bucket)))
+		recalled.extend(sample)
+		weights.extend([mem.get_recency_factor() for mem in sample])
+	if len(recalled) > 5:
+		new_recalled = []
+		for _ in range(5):
+			choice = random.choices(recalled, weights)[0]
+			ind = recalled.index(choice)
+			new_recalled.append(recalled.pop(ind))
+			weights.pop(ind)
+		recalled = new_recalled
+	return recalled
+
+
+def _time_call(func, repeats):
+	start = time.perf_counter()
+	for _ in range(repeats):
+		func()
+	return (time.perf_counter() - start) / repeats
+
+
+def bench_recall_random(sizes, repeats=20, nbits=LSH_NUM_BITS):
+	"""Times recall_random against the legacy per-bucket sampler"""
+	print(f"recall_random (nbits={nbits}, {repeats} repeats)")
+	print(f"{'memories':>10} {'legacy ms':>10} {'gumbel ms':>10}")
+	for size in sizes:
+		lsh = LSHMemory(nbits, LSH_VEC_DIM)
+		for memory in make_memories(size):
+			lsh.add_memory(memory)
+		legacy = _time_call(lambda: _legacy_recall_random(lsh), repeats)
+		gumbel = _time_call(lsh.recall_random, repeats)
+		print(f"{size:>10} {legacy * 1000:>10.3f} {gumbel * 1000:>10.3f}")
+
+
+def bench_bulk_load(sizes, embed_size=LSH_VEC_DIM, nbits=LSH_NUM_BITS):
+	"""Times inserting memories one at a time against a single batch insert"""
+	print(f"bulk load (nbits={nbits}, dim={embed_size})")
+	print(f"{'memories':>10} {'add_memory/s':>14} {'add_memories/s':>15}")
+	for size in sizes:
+		memories = make_memories(size, embed_size)
+		lsh = LSHMemory(nbits, embed_size)
+		single, _ = _timed(lambda: [lsh.add_memory(mem) for mem in memories])
+		lsh = LSHMemory(nbits, embed_size)
+		batch, _ = _timed(lsh.add_memories, memories)
+		print(f"{size:>10} {size / single:>14.0f} {size / batch:>15.0f}")
+
+
+def _make_ai_system(num_memories):
+	from main import AISystem  # pylint: disable=C0415
+
+	ai = AISystem()
+	ai.personality_system.summary = "A synthetic personality."
+	memories = make_memories(num_memories + 20)
+	ai.memory_system.long_term.lsh.add_memories(memories[:num_memories])
+	for memory in memories[num_memories:]:
+		memory.embedding = None
+		ai.memory_system.short_term.add_memory(memory)
+	return ai
+
+
+def _simulate_turn(ai):
+	# Recall one memory into short-term memory and evict the oldest, like a typical message
+	memory_system = ai.memory_system
+	recalled = memory_system.long_term.lsh.recall_random(remove=True, k=1)
+	for mem in recalled:
+		mem.reinforce()
+	memory_system.short_term.add_memories(recalled)
+	memory_system.short_term.add_memory(Memory("A new synthetic memory"))
+	evicted = memory_system.short_term.flush_old_memories()
+	for mem in evicted:
+		mem.embedding = np.zeros(LSH_VEC_DIM)
+		memory_system.long_term.lsh.add_memory(mem)
+	ai.buffer.add_message("user", "Hello!")
+
+
+def bench_persistence(sizes, repeats=5):
+	"""Times pickle save/load against incremental SQLite saves"""
+	print(f"persistence ({repeats} turns)")
+	print(
+		f"{'memories':>10} {'pickle save ms':>15} {'pickle load ms':>15} "
+		f"{'sqlite full ms':>15} {'sqlite turn ms':>15} {'sqlite load ms':>15}"
+	)
+	from main import AISystem  # pylint: disable=C0415
+
+	for size in sizes:
+		ai = _make_ai_system(size)
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			pickle_path = os.path.join(tmp_dir, "save.pkl")
+			pickle_save = pickle_load = turn_save = 0.0
+			store = SQLiteStore(os.path.join(tmp_dir, "save.db"))
+			start = time.perf_counter()
+			store.save(ai)
+			full_save = time.perf_counter() - start
+			for _ in range(repeats):
+				_simulate_turn(ai)
+				start = time.perf_counter()
+				ai.save(pickle_path)
+				pickle_save += time.perf_counter() - start
+				start = time.perf_counter()
+				store.save(ai)
+				turn_save += time.perf_counter() - start
+				start = time.perf_counter()
+				AISystem.load(pickle_path)
+				pickle_load += time.perf_counter() - start
+			store.close()
+
+			start = time.perf_counter()
+			store = SQLiteStore(os.path.join(tmp_dir, "save.db"))
+			AISystem.load_from_store(store)
+			store_load = time.perf_counter() - start
+			store.close()
+		print(
+			f"{size:>10} {pickle_save / repeats * 1000:>15.2f} {pickle_load / repeats * 1000:>15.2f} "
+			f"{full_save * 1000:>15.2f} {turn_save / repeats * 1000:>15.2f} {store_load * 1000:>15.2f}"
+		)
+
+
+def _legacy_prompt_inputs(ai):
+	# What appraisal, thinking and the response each rebuilt for themselves before they shared a TurnContext
+	history = ai.get_message_history()
+	messages = ai.get_message_history(False)
+	memories = ai.memory_system.get_short_term_memories()
+	beliefs = ai.memory_system.get_relevant_beliefs()
+	appraisal = (
+		format_memories_to_string(memories, "None"),
+		"\n".join(f"- {belief}" for belief in beliefs) if beliefs else "None",
+		conversation_to_string(messages)
+	)
+	think = (
+		format_memories_to_string(memories, "You don't have any memories of this user yet!"),
+		"\n".join(f"- {belief}" for belief in beliefs) if beliefs else "None",
+		ai.personality_system.get_summary(),
+		ai.emotion_system.get_mood_long_description(),
+		clock.now().strftime("%a, %m/%d/%Y"),
+		clock.now().strftime("%I:%M %p"),
+		ai.emotion_system.get_mood_prompt(),
+		ai.relation_system.get_string(),
+		time_since_last_message_string(ai.last_message)
+	)
+	now = clock.now()
+	response_beliefs = ai.memory_system.get_relevant_beliefs()
+	response = (
+		"\n".join(f"- {belief}" for belief in response_beliefs) if response_beliefs else "None",
+		ai.personality_system.get_summary(),
+		format_memories_to_string(memories, "You don't have any memories of this user yet!"),
+		now.strftime("%a, %m/%d/%Y"),
+		now.strftime("%I:%M %p"),
+		ai.emotion_system.get_mood_long_description(),
+		ai.emotion_system.get_mood_prompt(),
+		time_since_last_message_string(ai.last_message)
+	)
+	return history, appraisal, think, response
+
+
+def _shared_prompt_inputs(ai):
+	messages = ai.get_message_history(False)
+	memories = ai.memory_system.get_short_term_memories()
+	return ai._get_turn_context(messages, memories, [], ai.personality_system.get_summary())  # pylint: disable=W0212
+
+
+def _measure_turn(func, ai, repeats):
+	# Returns the mean time and the mean peak of memory allocated while building one turn's prompt inputs
+	start = time.perf_counter()
+	for _ in range(repeats):
+		func(ai)
+	elapsed = (time.perf_counter() - start) / repeats
+	peak = 0
+	tracemalloc.start()
+	for _ in range(repeats):
+		tracemalloc.reset_peak()
+		before = tracemalloc.get_traced_memory()[0]
+		result = func(ai)
+		peak += tracemalloc.get_traced_memory()[1] - before
+		del result
+	tracemalloc.stop()
+	return elapsed, peak / repeats
+
+
+def bench_turn_context(num_beliefs=(0, 50, 250), repeats=200):
+	"""Times building a turn's prompt inputs once in a TurnContext against rebuilding them in each subsystem"""
+	print(f"turn context ({repeats} turns, 20 short-term memories, 20 messages)")
+	print(f"{'beliefs':>10} {'legacy us':>10} {'shared us':>10} {'legacy KiB':>11} {'shared KiB':>11}")
+	for size in num_beliefs:
+		ai = _make_ai_system(0)
+		for i in range(20):
+			ai.buffer.add_message("user" if i % 2 == 0 else "assistant", f"Synthetic message #{i} " * 10)
+		ai.memory_system.belief_system.set_beliefs([
+			{"content": f"Synthetic belief #{i} about the user.", "importance": 0.5}
+			for i in range(size)
+		])
+		ai.last_message = clock.now() - timedelta(minutes=5)
+		legacy_time, legacy_peak = _measure_turn(_legacy_prompt_inputs, ai, repeats)
+		shared_time, shared_peak = _measure_turn(_shared_prompt_inputs, ai, repeats)
+		print(
+			f"{size:>10} {legacy_time * 1e6:>10.1f} {shared_time * 1e6:>10.1f} "
+			f"{legacy_peak / 1024:>11.1f} {shared_peak / 1024:>11.1f}"
+		)
+
+
+def bench_fused(latencies=(0.0, 0.1, 0.3), turns=20):
+	"""Times whole turns of the standard pipeline against low-latency mode, on the local stand-in for the API"""
+	import llm  # pylint: disable=C0415
+	from main import AISystem, AIConfig  # pylint: disable=C0415
+	from simulate import StubBackend, make_message  # pylint: disable=C0415
+
+	print(f"fused turn ({turns} turns)")
+	print(f"{'call ms':>8} {'mode':>10} {'turn ms':>8} {'p95 ms':>8} {'calls/turn':>11}")
+	for latency in latencies:
+		for low_latency in (False, True):
+			backend = StubBackend(seed=0, latency=latency)
+			previous = llm.set_backend(backend)
+			try:
+				with contextlib.redirect_stdout(sys.stderr):
+					ai = AISystem(AIConfig(low_latency=low_latency))
+					# Otherwise a stand-in summary would be cached on disk for the real personality
+					ai.personality_system.summary = "A synthetic personality."
+					ai.set_thought_visibility(False)
+					rng = random.Random(0)
+					turn_times = []
+					calls = backend.calls["chat"]
+					for _ in range(turns):
+						ai.wait_for_background_work()
+						elapsed, _ = _timed(ai.send_message, make_message(rng))
+						turn_times.append(elapsed)
+					ai.wait_for_background_work()
+					chat_calls = (backend.calls["chat"] - calls) / turns
+			finally:
+				llm.set_backend(previous)
+			mode = "fused" if low_latency else "standard"
+			stats = _latency_stats(turn_times)
+			print(
+				f"{latency * 1000:>8.0f} {mode:>10} {stats['mean_ms']:>8.1f} "
+				f"{np.percentile(np.asarray(turn_times) * 1000, 95):>8.1f} {chat_calls:>11.2f}"
+			)
+
+
+def _fine_step_moods(emotion_system, start_mood, sim_clock, seconds, step, trials, rng):
+	# The mood relaxation before it was done in closed form, in short sub-steps, for many trials at once
+	sigma = 0.006 * 3**emotion_system.personality_system.neurotic
+	moods = np.tile(start_mood, (trials, 1))
+	t = 0.0
+	while t < seconds:
+		dt = min(step, seconds - t)
+		sim_clock.advance(dt)
+		t += dt
+		moods += rng.normal(0, sigma * np.sqrt(dt), size=moods.shape)
+		moods /= np.maximum(1.0, np.abs(moods).max(axis=1, keepdims=True))
+		base = emotion_system.get_base_mood()
+		moods += (np.array([base.pleasure, base.arousal, base.dominance]) - moods) * (1 - 0.5 ** (dt / MOOD_HALF_LIFE))
+	return moods
+
+
+def _closed_form_moods(emotion_system, start_mood, seconds, trials):
+	# The mood relaxation as it's done now, in one exact step per trial
+	moods = np.empty((trials, 3))
+	for i in range(trials):
+		emotion_system.mood = Emotion(*start_mood)
+		emotion_system._tick_mood_decay(seconds)  # pylint: disable=W0212
+		moods[i] = (emotion_system.mood.pleasure, emotion_system.mood.arousal, emotion_system.mood.dominance)
+	return moods
+
+
+def bench_mood(hours=(0.25, 1, 6, 24, 72), trials=2000, step=2.0, seed=0):
+	"""Checks that the closed-form mood relaxation matches a fine-step reference in mean and variance"""
+	print(f"mood relaxation ({trials} trials, {step:g} s reference steps)")
+	print(
+		f"{'hours':>6} {'axis':>10} {'ref mean':>9} {'exact mean':>11} {'z':>6} "
+		f"{'ref std':>8} {'exact std':>10} {'var ratio':>10}"
+	)
+	start = datetime(2025, 1, 1, 7, 0)
+	start_mood = (0.6, -0.5, 0.4)
+	sim_clock = clock.SimulatedClock(start)
+	previous_clock = clock.set_clock(sim_clock)
+	try:
+		with contextlib.redirect_stdout(sys.stderr):
+			emotion_system = _make_ai_system(0).emotion_system
+		for num_hours in hours:
+			seconds = num_hours * 3600
+			sim_clock.current = start
+			reference = _fine_step_moods(
+				emotion_system, start_mood, sim_clock, seconds, step, trials, np.random.default_rng(seed)
+			)
+			# The clock now reads the end of the interval, as it does when the mood is ticked
+			random.seed(seed)
+			exact = _closed_form_moods(emotion_system, start_mood, seconds, trials)
+			for axis, name in enumerate(("pleasure", "arousal", "dominance")):
+				ref_mean, exact_mean = reference[:, axis].mean(), exact[:, axis].mean()
+				ref_var, exact_var = reference[:, axis].var(ddof=1), exact[:, axis].var(ddof=1)
+				# How many standard errors apart the two means are
+				z = (exact_mean - ref_mean) / np.sqrt((ref_var + exact_var) / trials)
+				print(
+					f"{num_hours:>6g} {name:>10} {ref_mean:>9.4f} {exact_mean:>11.4f} {z:>6.2f} "
+					f"{np.sqrt(ref_var):>8.4f} {np.sqrt(exact_var):>10.4f} {exact_var / ref_var:>10.3f}"
+				)
+	finally:
+		clock.set_clock(previous_clock)
+
+
+def _get_state_fingerprint(ai):
+	# Everything a turn can change, including the arrays the LSH index keeps alongside each memory
+	memory_system = ai.memory_system
+	long_term = memory_system.long_term
+	emotion_system = ai.emotion_system
+	buckets = []
+	for hash_ind, bucket in sorted(long_term.lsh.table.items()):
+		size = len(bucket)
+		order = np.argsort([mem.id for mem in bucket.memories], kind="stable")
+		buckets.append((
+			hash_ind,
+			[bucket.memories[i].id for i in order],
+			[(bucket.memories[i].strength, bucket.memories[i].last_accessed) for i in order],
+			bucket.times[:size][order].tolist(),
+			bucket.strengths[:size][order].tolist()
+		))
+	return {
+		"short_term": [(mem.id, mem.strength, mem.last_accessed) for mem in memory_system.short_term.memories],
+		"short_term_index": [mem.id for mem in memory_system.short_term.time_index.get_range()],
+		"long_term": buckets,
+		"long_term_time_index": [mem.id for mem in long_term.lsh.time_index.get_range()],
+		"pending": sorted(long_term.pending),
+		"num_forgotten": long_term.num_forgotten,
+		"messages": list(ai.buffer.messages),
+		"mood": (emotion_system.mood.pleasure, emotion_system.mood.arousal, emotion_system.mood.dominance),
+		"emotions": emotion_system.emotion_buffer[emotion_system._get_emotion_rows()].tolist(),  # pylint: disable=W0212
+		"mood_history": emotion_system.recorder.get_history().tolist(),
+		"relation": (ai.relation_system.friendliness, ai.relation_system.dominance),
+		"scalars": (
+			ai.last_tick,
+			ai.last_message,
+			ai.last_recall_tick,
+			memory_system.importance_counter,
+			memory_system.last_memory,
+			memory_system.belief_system.elapsed,
+			ai.thought_system.last_reflection
+		)
+	}
+
+
+def bench_rollback(sizes, repeats=5):
+	"""Checks that a failed message leaves the AI system unchanged, and times taking a snapshot against deepcopy"""
+	import llm  # pylint: disable=C0415
+	from simulate import StubBackend  # pylint: disable=C0415
+
+	class FailingBackend(StubBackend):
+		"""Fails the call that generates the response, after everything before it has changed the AI's state"""
+
+		def chat(self, data):
+			if data["response_format"]["type"] == "text" and data["model"] != "open-mistral-nemo":
+				raise RuntimeError("Simulated API failure")
+			return super().chat(data)
+
+	print(f"rollback ({repeats} repeats)")
+	print(
+		f"{'memories':>10} {'restored':>9} {'deepcopy ms':>12} {'snapshot ms':>12} "
+		f"{'rollback ms':>12} {'deepcopy KiB':>13} {'snapshot KiB':>13}"
+	)
+	sim_clock = clock.SimulatedClock(datetime.now())
+	previous_clock = clock.set_clock(sim_clock)
+	previous_backend = llm.set_backend(FailingBackend(seed=0))
+	try:
+		for size in sizes:
+			with contextlib.redirect_stdout(sys.stderr):
+				ai = _make_ai_system(size)
+				ai.set_thought_visibility(False)
+				for i in range(20):
+					ai.buffer.add_message("user" if i % 2 == 0 else "assistant", f"Synthetic message #{i}")
+				ai.tick()
+				# Hours pass, so the failed message's tick forgets memories and surfaces random thoughts too
+				restored = True
+				for _ in range(repeats):
+					sim_clock.advance(3 * 3600)
+					before = _get_state_fingerprint(ai)
+					try:
+						ai.send_message("Synthetic message about a synthetic memory")
+					except RuntimeError:
+						pass
+					restored = restored and _get_state_fingerprint(ai) == before
+
+			deepcopy_time = _time_call(lambda: copy.deepcopy(ai), repeats)
+			snapshot_time = _time_call(lambda: Transaction(ai).commit(), repeats)
+			rollback_time = _time_call(lambda: Transaction(ai).rollback(), repeats)
+			tracemalloc.start()
+			copied = copy.deepcopy(ai)
+			deepcopy_size = tracemalloc.get_traced_memory()[0]
+			del copied
+			tracemalloc.stop()
+			tracemalloc.start()
+			transaction = Transaction(ai)
+			snapshot_size = tracemalloc.get_traced_memory()[0]
+			transaction.commit()
+			del transaction
+			tracemalloc.stop()
+			print(
+				f"{size:>10} {'yes' if restored else 'NO':>9} {deepcopy_time * 1000:>12.2f} {snapshot_time * 1000:>12.3f} "
+				f"{rollback_time * 1000:>12.3f} {deepcopy_size / 1024:>13.0f} {snapshot_size / 1024:>13.1f}"
+			)
+	finally:
+		clock.set_clock(previous_clock)
+		llm.set_backend(previous_backend)
+
+
+# Run in a checkout of an older revision to make a pickle save the way that revision did
+OLD_SAVE_SCRIPT = """
+import sys
+import numpy as np
+from const import LSH_VEC_DIM
+from main import AISystem
+from memory_system import Memory
+
+save_path, num_memories = sys.argv[1], int(sys.argv[2])
+rng = np.random.default_rng(0)
+ai = AISystem()
+for i in range(num_memories + 5):
+	memory = Memory(f"Synthetic memory #{i}")
+	memory.embedding = rng.normal(size=LSH_VEC_DIM)
+	if i < num_memories:
+		ai.memory_system.long_term.lsh.add_memory(memory)
+	else:
+		ai.memory_system.short_term.add_memory(memory)
+ai.buffer.add_message("user", "Synthetic message")
+ai.buffer.add_message("assistant", "Synthetic reply")
+ai.save(save_path)
+"""
+
+
+def _get_root_revision():
+	return subprocess.run(
+		["git", "rev-list", "--max-parents=0", "HEAD"],
+		cwd=os.path.dirname(os.path.abspath(__file__)),
+		capture_output=True,
+		text=True,
+		check=True
+	).stdout.split()[0]
+
+
+def bench_upgrade(rev=None, sizes=(1000,)):
+	"""Loads pickle saves made by an older revision, then runs a turn and saves and reloads them with SQLite"""
+	import llm  # pylint: disable=C0415
+	from main import AISystem  # pylint: disable=C0415
+	from simulate import StubBackend  # pylint: disable=C0415
+
+	rev = rev or _get_root_revision()
+	print(f"upgrade from {rev[:10]}")
+	print(f"{'memories':>10} {'loaded':>7} {'load ms':>8} {'turn':>5} {'reloaded':>9}")
+	cwd = os.getcwd()
+	previous_backend = llm.set_backend(StubBackend(seed=0))
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		old_tree = os.path.join(tmp_dir, "old")
+		archive = subprocess.run(
+			["git", "archive", rev],
+			cwd=os.path.dirname(os.path.abspath(__file__)),
+			capture_output=True,
+			check=True
+		).stdout
+		with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+			tar.extractall(old_tree)
+		# The summary cache and anything else the AI system writes stay out of the real working directory
+		os.chdir(tmp_dir)
+		try:
+			for size in sizes:
+				save_path = os.path.join(tmp_dir, f"save_{size}.pkl")
+				subprocess.run(
+					[sys.executable, "-c", OLD_SAVE_SCRIPT, save_path, str(size)],
+					cwd=old_tree,
+					capture_output=True,
+					check=True
+				)
+				with contextlib.redirect_stdout(sys.stderr):
+					load_time, ai = _timed(AISystem.load, save_path)
+					long_term = ai.memory_system.long_term
+					loaded = (
+						len(long_term.get_memories()) == size
+						and len(ai.get_memories()) == 5
+						and len(ai.get_message_history(False)) == 2
+					)
+					ai.set_thought_visibility(False)
+					ai.on_startup()
+					turn_ok = bool(ai.send_message("Synthetic message about a synthetic memory"))
+					ai.wait_for_background_work()
+					num_memories = len(long_term.get_memories()) + len(ai.get_memories())
+					store = SQLiteStore(os.path.join(tmp_dir, f"save_{size}.db"))
+					store.save(ai)
+					store.close()
+					reloaded = AISystem.load_from_store(SQLiteStore(os.path.join(tmp_dir, f"save_{size}.db")))
+					reloaded_ok = (
+						len(reloaded.memory_system.long_term.get_memories()) + len(reloaded.get_memories())
+						== num_memories
+					)
+				print(
+					f"{size:>10} {'yes' if loaded else 'NO':>7} {load_time * 1000:>8.1f} "
+					f"{'yes' if turn_ok else 'NO':>5} {'yes' if reloaded_ok else 'NO':>9}"
+				)
+		finally:
+			os.chdir(cwd)
+			llm.set_backend(previous_backend)
+
+
+def _rss_bytes():
+	# Current resident set size, where the platform exposes it
+	try:
+		with open("/proc/self/statm", encoding="utf-8") as file:
+			return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+	except (OSError, ValueError, AttributeError):
+		return None
+
+
+def _latency_stats(samples):
+	samples = np.asarray(samples) * 1000
+	return {
+		"count": int(len(samples)),
+		"p50_ms": float(np.percentile(samples, 50)),
+		"p99_ms": float(np.percentile(samples, 99)),
+		"mean_ms": float(samples.mean())
+	}
+
+
+def _timed(func, *args, **kwargs):
+	start = time.perf_counter()
+	result = func(*args, **kwargs)
+	return time.perf_counter() - start, result
+
+
+def bench_backend(name, memories, queries, context, truth, k=3, num_ops=200):
+	"""Runs every memory operation against one backend and returns a result row"""
+	embed_size = len(memories[0].embedding)
+	rss_before = _rss_bytes()
+	backend = BACKENDS[name](embed_size)
+	add_times = []
+	build_start = time.perf_counter()
+	for memory in memories:
+		elapsed, _ = _timed(backend.add_memory, memory)
+		add_times.append(elapsed)
+	build_time = time.perf_counter() - build_start
+	rss_after = _rss_bytes()
+
+	retrieve_times = []
+	hits = 0
+	for query, expected in zip(queries, truth):
+		elapsed, retrieved = _timed(backend.retrieve, query, k, context=context)
+		retrieve_times.append(elapsed)
+		hits += len({mem.id for mem in retrieved} & expected)
+
+	recall_random_times = [_timed(backend.recall_random)[0] for _ in range(num_ops)]
+
+	# Delete and re-add a sample, so the index ends up unchanged
+	rng = random.Random(0)
+	sample = rng.sample(memories, min(num_ops, len(memories)))
+	delete_times = [_timed(backend.delete_memory, mem)[0] for mem in sample]
+	readd_times = [_timed(backend.add_memory, mem)[0] for mem in sample]
+
+	long_term = LongTermMemory(backend)
+	with contextlib.redirect_stdout(sys.stderr):  # Keep forgetting logs out of the report
+		tick_times = [_timed(long_term.tick, 60)[0] for _ in range(3)]
+
+	return {
+		"backend": name,
+		"num_memories": len(memories),
+		"embed_size": embed_size,
+		"k": k,
+		f"recall_at_{k}": hits / (k * len(queries)),
+		"build_time_s": build_time,
+		"rss_delta_bytes": None if rss_before is None else rss_after - rss_before,
+		"latency": {
+			"add_memory": _latency_stats(add_times + readd_times),
+			"retrieve": _latency_stats(retrieve_times),
+			"recall_random": _latency_stats(recall_random_times),
+			"delete_memory": _latency_stats(delete_times),
+			"tick": _latency_stats(tick_times)
+		}
+	}
+
+
+def bench_retrieval(sizes, backends, embed_size=LSH_VEC_DIM, num_queries=200, k=3):
+	"""Compares memory backends on a synthetic corpus of each size.
+	Returns a JSON-serializable report."""
+	results = []
+	for size in sizes:
+		memories, _ = make_corpus(size, embed_size=embed_size)
+		queries, context = make_queries(memories, num_queries)
+		exact = ExactMemory()
+		for memory in memories:
+			exact.add_memory(memory)
+		truth = [{mem.id for mem in exact.retrieve(q, k, context=context)} for q in queries]
+		del exact
+		for name in backends:
+			print(f"Benchmarking {name} with {size} memories...", file=sys.stderr)
+			results.append(bench_backend(name, memories, queries, context, truth, k=k))
+	return {
+		"benchmark": "retrieval",
+		"timestamp": datetime.now().isoformat(),
+		"python": platform.python_version(),
+		"numpy": np.__version__,
+		"machine": platform.machine(),
+		"results": results
+	}
+
+
+def main():
+	"""Runs the benchmarks"""
+	parser = argparse.ArgumentParser(description=__doc__)
+	subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+	retrieval = subparsers.add_parser("retrieval", help="compare memory backends (JSON output)")
+	retrieval.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+	retrieval.add_argument("--backends", nargs="+", choices=list(BACKENDS), default=list(BACKENDS))
+	retrieval.add_argument("--dim", type=int, default=LSH_VEC_DIM, help="embedding size (lower it for 1M memories)")
+	retrieval.add_argument("--queries", type=int, default=200)
+	retrieval.add_argument("-k", type=int, default=3)
+	retrieval.add_argument("--output", help="write the JSON report here instead of stdout")
+
+	recall = subparsers.add_parser("recall_random", help="time recall_random against the legacy sampler")
+	recall.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+	recall.add_argument("--repeats", type=int, default=20)
+
+	bulk_load = subparsers.add_parser("bulk_load", help="time one-at-a-time against batch LSH inserts")
+	bulk_load.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+	bulk_load.add_argument("--dim", type=int, default=LSH_VEC_DIM)
+
+	persistence = subparsers.add_parser("persistence", help="time pickle against SQLite saves")
+	persistence.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+	persistence.add_argument("--repeats", type=int, default=5)
+
+	turn_context = subparsers.add_parser("turn_context", help="time building prompt inputs once per turn against per subsystem")
+	turn_context.add_argument("--beliefs", type=int, nargs="+", default=[0, 50, 250])
+	turn_context.add_argument("--repeats", type=int, default=200)
+
+	fused = subparsers.add_parser("fused", help="time the standard pipeline against low-latency mode")
+	fused.add_argument("--latencies", type=float, nargs="+", default=[0.0, 0.1, 0.3], help="seconds per API call")
+	fused.add_argument("--turns", type=int, default=20)
+
+	mood = subparsers.add_parser("mood", help="check the closed-form mood relaxation against fine sub-steps")
+	mood.add_argument("--hours", type=float, nargs="+", default=[0.25, 1, 6, 24, 72])
+	mood.add_argument("--trials", type=int, default=2000)
+	mood.add_argument("--step", type=float, default=2.0, help="seconds per reference step")
+	mood.add_argument("--seed", type=int, default=0)
+
+	upgrade = subparsers.add_parser("upgrade", help="load pickle saves made by an older revision of the repo")
+	upgrade.add_argument("--rev", help="the revision to save with (default: the first commit)")
+	upgrade.add_argument("--sizes", type=int, nargs="+", default=[1000])
+
+	rollback = subparsers.add_parser("rollback", help="check rolling back a failed message, and time it against deepcopy")
+	rollback.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+	rollback.add_argument("--repeats", type=int, default=5)
+
+	args = parser.parse_args()
+	if args.benchmark == "retrieval":
+		report = bench_retrieval(args.sizes, args.backends, args.dim, args.queries, args.k)
+		if args.output:
+			with open(args.output, "w", encoding="utf-8") as file:
+				json.dump(report, file, indent=2)
+		else:
+			print(json.dumps(report, indent=2))
+	elif args.benchmark == "recall_random":
+		bench_recall_random(args.sizes, args.repeats)
+	elif args.benchmark == "bulk_load":
+		bench_bulk_load(args.sizes, args.dim)
+	elif args.benchmark == "persistence":
+		bench_persistence(args.sizes, args.repeats)
+	elif args.benchmark == "turn_context":
+		bench_turn_context(args.beliefs, args.repeats)
+	elif args.benchmark == "fused":
+		bench_fused(args.latencies, args.turns)
+	elif args.benchmark == "mood":
+		bench_mood(args.hours, args.trials, args.step, args.seed)
+	elif args.benchmark == "upgrade":
+		bench_upgrade(args.rev, args.sizes)
+	elif args.benchmark == "rollback":
+		bench_rollback(args.sizes, args.repeats)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,61 @@
+"""The clock the AI system reads the time from, which can be swapped out to simulate the passage of time."""
+
+import time as _time
+from datetime import datetime, timedelta
+
+
+class SystemClock:
+	"""Reads the real time"""
+
+	def now(self):
+		"""Returns the current local datetime"""
+		return datetime.now()
+
+	def time(self):
+		"""Returns the current time as a Unix timestamp"""
+		return _time.time()
+
+
+class SimulatedClock:
+	"""A clock that only moves forward when advanced"""
+
+	def __init__(self, start=None):
+		self.current = start or datetime.now()
+
+	def now(self):
+		"""Returns the current local datetime"""
+		return self.current
+
+	def time(self):
+		"""Returns the current time as a Unix timestamp"""
+		return self.current.timestamp()
+
+	def advance(self, seconds):
+		"""Moves the clock forward by a number of seconds"""
+		self.current += timedelta(seconds=seconds)
+
+
+_clock = SystemClock()
+
+
+def get_clock():
+	"""Returns the clock in use"""
+	return _clock
+
+
+def set_clock(clock):
+	"""Replaces the clock in use, and returns the previous one"""
+	global _clock  # pylint: disable=W0603
+	previous = _clock
+	_clock = clock
+	return previous
+
+
+def now():
+	"""Returns the current local datetime according to the clock in use"""
+	return _clock.now()
+
+
+def time():
+	"""Returns the current Unix timestamp according to the clock in use"""
+	return _clock.time()
@@ -3,6 +3,10 @@
 EMOTION_HALF_LIFE = 10
 MOOD_HALF_LIFE = 10 * 60
 MOOD_CHANGE_VEL = 0.06
+MAX_ACTIVE_EMOTIONS = 64
+APPRAISAL_LOCAL_MAX_WORDS = 6  # Longer messages always get the LLM appraisal
+APPRAISAL_CONFIDENCE_THRESHOLD = 0.8  # Below this, the local appraisal escalates to the LLM
+APPRAISAL_SHADOW_RATE = 0.1  # Fraction of local appraisals also checked against the LLM in the background
 MODD_INTENSITY_FACTOR = 0.3
 PERSONALITY_INTENSITY_FACTOR = 0.3
 LSH_VEC_DIM = 1024
@@ -10,8 +14,30 @@ LSH_NUM_BITS = 2
 MEMORY_DECAY_TIME_MULT = 1.5
 MEMORY_RECENCY_FORGET_THRESHOLD = 0.7
 MAX_THOUGHT_STEPS = 6
+THINKING_BUDGET = 20  # Seconds from the start of a message until thinking must stop
+THINKING_TOKEN_BUDGET = 4000  # Estimated tokens that extra thinking steps may add
+THINKING_LATENCY_SMOOTHING = 0.3
+THOUGHT_RETRY_SAMPLES = 4  # Candidates requested in one call when the first thought output is empty
+THOUGHT_MAX_RETRIES = 5  # Calls made by the sequential retry strategy
 MEMORY_RETRIEVAL_TOP_K = 3
+CONSOLIDATION_BATCH_SIZE = 4
+CONSOLIDATION_QUEUE_SIZE = 32
+BELIEF_SIMILARITY_THRESHOLD = 0.9
+BELIEF_SOURCE_SIMILARITY_THRESHOLD = 0.92
+BELIEF_QUEUE_SIZE = 16
+BELIEF_HALF_LIFE = 20 * 86400
+BELIEF_IMPORTANCE_WEIGHT = 0.5
+BELIEF_PROMPT_TOP_K = 12
+BELIEF_PROMPT_TOKEN_BUDGET = 300
+MOOD_SAMPLE_INTERVAL = 60
+MOOD_HISTORY_SIZE = 1440
+MOOD_HISTORY_DOWNSAMPLE = 30
+MOOD_EXPORT_PATH = "mood_history.csv"
+PERSONALITY_SUMMARY_CACHE_PATH = "personality_summaries.json"
+STAGE_WORKERS = 8
+REFLECTION_CONCURRENCY = 4  # LLM calls that reflection makes at the same time
 SAVE_PATH = "ai_system_save.pkl"
+DB_PATH = "ai_system.db"
 
 EMOTION_MAP = {
 	"Admiration": (0.5, 0.3, -0.2),
@@ -246,7 +272,7 @@ Overall mood: {mood_prompt}
 
 # Beliefs
 
-{name}'s current beliefs (from most to least important):
+{name}'s current beliefs (most relevant first):
 {beliefs}
 
 # Last User Input
@@ -507,6 +533,82 @@ APPRAISAL_SCHEMA = {
 }
 
 
+# Appraisal, thoughts and the response in one object, for low-latency mode.
+# The response comes last, so that it's written after the thoughts it should follow from.
+FUSED_SCHEMA = {
+	"type": "object",
+	"properties": {
+		"appraisal": {key: value for key, value in APPRAISAL_SCHEMA.items() if key != "$defs"},
+		**{key: value for key, value in THOUGHT_SCHEMA["properties"].items() if key != "next_action"},
+		"response": {"type": "string"}
+	},
+	"required": [
+		"appraisal",
+		*[key for key in THOUGHT_SCHEMA["required"] if key != "next_action"],
+		"response"
+	],
+	"additionalProperties": False,
+	"$defs": APPRAISAL_SCHEMA["$defs"]
+}
+
+FUSED_PROMPT = """# Context
+
+You are {name}, and are currently in a conversation wth the user.
+
+# Personality
+
+{name}'s personality: {personality_summary}
+
+# {name}'s Memories
+
+Here are the memories on {name}'s mind right now:
+
+{memories}
+
+# Current Relationship
+
+Below is {name}'s relationship with the user, reflecting how {name} feels about them given previous conversations.
+The amount of "+"s or "-"s reflects how positive or negative each value is.
+If there is an "=", it means that the value is neutral.
+
+{relationship_str}
+
+# Current Mood
+
+{name}'s mood is represented in the PAD (Pleasure-Arousal-Dominance) space below, each value ranging from -1.0 to +1.0: 
+{mood_long_desc}
+Overall mood: {mood_prompt}
+
+# Beliefs
+
+{name}'s current beliefs (most relevant first):
+{beliefs}
+
+# Last User Input
+	
+The last interaction with the user was {last_interaction}.
+Today is {curr_date}, and it is {curr_time}.
+
+User: {user_input}
+
+# Instructions
+
+In a single JSON object, appraise the user input, think about it, and then respond to the user as {name}.
+
+1. "appraisal": Appraise the user input as an event and as actions.
+	- events.self: how it affects {name} (desirability from -100 to 100, 0 if not affected), and whether it's a prospect rather than something that happened.
+	- events.other: how it affects the user (desirability from -100 to 100, 0 if not affected).
+	- actions.self / actions.other: anything {name} or the user did, and its praiseworthiness from -100 (most blameworthy) to 100 (most praiseworthy), 0 if there was no action.
+	Use null for any event or action that doesn't apply.
+2. "thoughts": 5 first-person thoughts from {name}'s perspective, 1-2 sentences each. \
+The user will not see these, so refer to the user in third person (e.g. 'the user' or 'they').
+3. "emotion_reason", "emotion" and "emotion_intensity" (1 to 10): how the user input makes {name} feel, and why. \
+Use one of the emotion names from the schema (e.g. Joy, Distress, Hope, Fear, Admiration, Reproach, Gratitude, Anger, Love).
+4. "possible_user_emotions": adjectives for how the user might be feeling, or `[]` if there isn't enough to say.
+5. "relationship_change": how this interaction changes "friendliness" and "dominance" in the relationship, each from -2.0 to 2.0.
+6. "response": {name}'s response to the user. Make sure its tone is subtly influenced by {name}'s emotion. \
+Do not mention your thought process directly unless explicitly asked."""
+
 HIGHER_ORDER_THOUGHTS = """You've decided to engage in deeper thought before responding (a.k.a. "System 2 thinking"). You have the opportunity to engage in deeper thought. Given your previous thoughts and the previous context, generate a set of new thoughts.
 Use the same JSON format as before.
 
@@ -1,9 +1,15 @@
 """The system that manages the AI's emotions"""
 
+import os
+import json
 import math
-import time
 import random
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import numpy as np
+
 from const import (
 	SUMMARIZE_PERSONALITY,
 	EMOTION_MAP,
@@ -13,19 +19,39 @@ from const import (
 	MOOD_HALF_LIFE,
 	EMOTION_HALF_LIFE,
 	MOOD_CHANGE_VEL,
+	MAX_ACTIVE_EMOTIONS,
 	APPRAISAL_PROMPT,
 	EMOTION_APPRAISAL_CONTEXT_TEMPLATE,
-	APPRAISAL_SCHEMA
+	APPRAISAL_SCHEMA,
+	APPRAISAL_CONFIDENCE_THRESHOLD,
+	APPRAISAL_SHADOW_RATE,
+	PERSONALITY_SUMMARY_CACHE_PATH
 )
 from utils import (
 	num_to_str_sign,
-	val_to_symbol_color,
-	format_memories_to_string,
-	conversation_to_string
+	val_to_symbol_color
 )
 from llm import MistralLLM
+import clock
+from mood_recorder import MoodRecorder
+from appraisal_classifier import quick_appraisal, AppraisalStats
 from colored import Fore
 
+MOOD_DECAY_RATE = math.log(2) / MOOD_HALF_LIFE
+# Anything further back than this many half-lives no longer affects the mood
+MOOD_MEMORY_HALF_LIVES = 30
+ENERGY_CYCLE_SHIFT = 2  # Hours
+ENERGY_CYCLE_FREQ = math.pi / (12 * 3600)  # Radians per second
+SUMMARY_MODEL = "mistral-medium-latest"
+
+# Personality summaries, shared by every PersonalitySystem in the process and persisted to disk
+_summary_cache = None
+_summary_lock = threading.Lock()
+_summary_futures = {}
+_summary_executor = ThreadPoolExecutor(max_workers=1)
+# Runs the LLM appraisals that local appraisals are compared against
+_shadow_executor = ThreadPoolExecutor(max_workers=1)
+
 
 def get_default_mood(openness, conscientious, extrovert, agreeable, neurotic):
 	"""Converts the big five personality values into a PAD emotion vectoe"""
@@ -36,9 +62,18 @@ def get_default_mood(openness, conscientious, extrovert, agreeable, neurotic):
 	return (pleasure, arousal, dominance)
 	
 
+def integrate_decaying_cos(rate, freq, phase, start, end, t):
+	"""Integrates rate * e^(-rate*(t-s)) * cos(freq*s + phase) over s from start to end"""
+	def antiderivative(s):
+		angle = freq * s + phase
+		weight = rate * math.exp(-rate * (t - s)) / (rate**2 + freq**2)
+		return weight * (rate * math.cos(angle) + freq * math.sin(angle))
+	return antiderivative(end) - antiderivative(start)
+
+
 def summarize_personality(openness, conscientious, extrovert, agreeable, neurotic):
 	"""Summarizes the personality values into a natural language personality description."""
-	model = MistralLLM("mistral-medium-latest")
+	model = MistralLLM(SUMMARY_MODEL)
 	personality_str = "\n".join([
 		f"Openness: {num_to_str_sign(openness, 2)}",
 		f"Conscientiousness: {num_to_str_sign(conscientious, 2)}",
@@ -55,6 +90,75 @@ def summarize_personality(openness, conscientious, extrovert, agreeable, neuroti
 	)
 
 
+def _get_summary_key(traits):
+	# The prompt only shows the values to 2 decimals, so personalities that round the same get the same summary
+	return "|".join([SUMMARY_MODEL, *(f"{value:.2f}" for value in traits)])
+
+
+def _get_summary_cache():
+	global _summary_cache  # pylint: disable=W0603
+	if _summary_cache is None:
+		_summary_cache = {}
+		if os.path.exists(PERSONALITY_SUMMARY_CACHE_PATH):
+			try:
+				with open(PERSONALITY_SUMMARY_CACHE_PATH, "r", encoding="utf-8") as file:
+					_summary_cache = json.load(file)
+			except (OSError, ValueError):
+				pass
+	return _summary_cache
+
+
+def _save_summary_cache(cache):
+	tmp_path = PERSONALITY_SUMMARY_CACHE_PATH + ".tmp"
+	with open(tmp_path, "w", encoding="utf-8") as file:
+		json.dump(cache, file, indent=1)
+	os.replace(tmp_path, PERSONALITY_SUMMARY_CACHE_PATH)
+
+
+def _compute_summary(key, traits):
+	try:
+		summary = summarize_personality(*traits)
+	except BaseException:
+		# Forget the failed future, so the next call retries instead of re-raising
+		with _summary_lock:
+			_summary_futures.pop(key, None)
+		raise
+	with _summary_lock:
+		cache = _get_summary_cache()
+		cache[key] = summary
+		_summary_futures.pop(key, None)
+		try:
+			_save_summary_cache(cache)
+		except OSError:
+			pass
+	return summary
+
+
+def _get_summary_future(traits):
+	# Returns the cached summary, or the future of a summary being generated (starting it if needed)
+	key = _get_summary_key(traits)
+	with _summary_lock:
+		summary = _get_summary_cache().get(key)
+		if summary is not None:
+			return summary
+		future = _summary_futures.get(key)
+		if future is None:
+			future = _summary_executor.submit(_compute_summary, key, traits)
+			_summary_futures[key] = future
+		return future
+
+
+def get_personality_summary(traits):
+	"""Returns the summary of the personality values, generating it only if it isn't cached"""
+	summary = _get_summary_future(traits)
+	return summary if isinstance(summary, str) else summary.result()
+
+
+def prefetch_personality_summary(traits):
+	"""Starts generating the summary of the personality values in the background, if it isn't cached"""
+	_get_summary_future(traits)
+
+
 class PersonalitySystem:
 	"""The system that defines the AI's personality"""
 
@@ -67,17 +171,20 @@ class PersonalitySystem:
 		
 		self.summary = ""
 	
+	def get_traits(self):
+		"""Returns the Big Five personality values as a tuple"""
+		return (self.open, self.conscientious, self.extrovert, self.agreeable, self.neurotic)
+
 	def get_summary(self):
 		"""Generates a summary of the personality values"""
 		if not self.summary:
-			self.summary = summarize_personality(
-				self.open,
-				self.conscientious,
-				self.extrovert,
-				self.agreeable,
-				self.neurotic
-			)
+			self.summary = get_personality_summary(self.get_traits())
 		return self.summary
+
+	def prefetch_summary(self):
+		"""Starts generating the summary in the background, so it's ready by the time it's needed"""
+		if not self.summary:
+			prefetch_personality_summary(self.get_traits())
 	
 
 class Emotion:
@@ -221,6 +328,28 @@ class Emotion:
 			f"{round(self.arousal, 2):.2f}, {round(self.dominance, 2):.2f})"
 
 
+class EmotionView(Emotion):
+	"""An Emotion backed by a row of an array, so changes to it write through to the array"""
+
+	def __init__(self, row):  # pylint: disable=W0231
+		self.row = row
+
+	pleasure = property(lambda self: float(self.row[0]), lambda self, val: self.row.__setitem__(0, val))
+	arousal = property(lambda self: float(self.row[1]), lambda self, val: self.row.__setitem__(1, val))
+	dominance = property(lambda self: float(self.row[2]), lambda self, val: self.row.__setitem__(2, val))
+
+	def copy(self):
+		return Emotion(self.pleasure, self.arousal, self.dominance)
+
+	def __mul__(self, other):
+		return self.copy() * other
+
+	__rmul__ = __mul__
+
+	def __truediv__(self, other):
+		return self.copy() / other
+
+
 class RelationshipSystem:
 	"""The system that manages the AI's relationship with the user."""
 	relation_change_mult = 1.7
@@ -309,9 +438,43 @@ class EmotionSystem:
 		self.relation = relation_system
 		self.base_mood = base_mood
 		self.mood = self.get_base_mood()
-		self.last_update = time.time()
+		self.last_update = clock.time()
 		self.config = config
-		self.emotions = []
+		# Active emotions as rows of PAD values, in a ring buffer that overwrites the oldest when full
+		self.emotion_buffer = np.zeros((MAX_ACTIVE_EMOTIONS, 3))
+		self.emotion_start = 0
+		self.num_emotions = 0
+		self.recorder = MoodRecorder(config.mood_sample_interval)
+		self.appraisal_stats = AppraisalStats()
+
+	def __setstate__(self, state):
+		emotions = state.pop("emotions", None)
+		state.setdefault("recorder", MoodRecorder())
+		state.setdefault("appraisal_stats", AppraisalStats())
+		self.__dict__.update(state)
+		if emotions is not None:
+			# Saved when emotions were kept in a list
+			self.emotion_buffer = np.zeros((MAX_ACTIVE_EMOTIONS, 3))
+			self.emotions = emotions
+
+	def _get_emotion_rows(self):
+		return (self.emotion_start + np.arange(self.num_emotions)) % len(self.emotion_buffer)
+
+	def _set_emotion_array(self, array):
+		array = array[-len(self.emotion_buffer):]
+		self.emotion_buffer[:len(array)] = array
+		self.emotion_start = 0
+		self.num_emotions = len(array)
+
+	@property
+	def emotions(self):
+		"""The active emotions, as views into the emotion buffer"""
+		return [EmotionView(self.emotion_buffer[i]) for i in self._get_emotion_rows()]
+
+	@emotions.setter
+	def emotions(self, emotions):
+		array = np.array([[em.pleasure, em.arousal, em.dominance] for em in emotions]).reshape(-1, 3)
+		self._set_emotion_array(array)
 		
 	def _emotions_from_appraisal(self, appraisal):
 		events = appraisal["events"]
@@ -370,32 +533,41 @@ class EmotionSystem:
 		emotions.sort(key=lambda p: p[1], reverse=True)
 		return emotions
 		
-	def appraisal(self, messages, memories, beliefs):
-		memories_str = format_memories_to_string(memories, "None")
+	def appraisal(self, context):
+		"""Appraises the emotions the user's message evokes, given the turn's TurnContext.
+		Low-signal messages are appraised locally, and the rest escalate to the LLM."""
+		if context.image is None:
+			local_appraisal, confidence = quick_appraisal(context.user_text)
+			if confidence >= APPRAISAL_CONFIDENCE_THRESHOLD:
+				self.appraisal_stats.record(escalated=False)
+				emotions = self._emotions_from_appraisal(local_appraisal)
+				if random.random() < APPRAISAL_SHADOW_RATE:
+					_shadow_executor.submit(self._compare_appraisal, context, emotions)
+				return emotions
+		self.appraisal_stats.record(escalated=True)
+		return self._emotions_from_appraisal(self._llm_appraisal(context))
+
+	def _compare_appraisal(self, context, local_emotions):
+		try:
+			llm_emotions = self._emotions_from_appraisal(self._llm_appraisal(context))
+		except Exception:  # pylint: disable=W0718
+			return  # Only the comparison is lost
+		self.appraisal_stats.record_comparison(local_emotions, llm_emotions)
+
+	def _llm_appraisal(self, context):
 		sys_prompt = APPRAISAL_PROMPT.format(
 			sys_prompt=self.config.system_prompt
 		)
-		if beliefs:
-			belief_str = "\n".join(f"- {belief}" for belief in beliefs)
-		else:
-			belief_str = "None"
 		
-		content = messages[-1]["content"]
-
-		img_data = None
-		if isinstance(content, list):
-			assert len(content) == 2
-			assert content[0]["type"] == "text"
-			assert content[1]["type"] == "image_url"
-			text_content = content[0]["text"] + "\n\n((The user attached an image to this message - please see the attached image.))"
-			img_data = content[1]
-		else:
-			text_content = content
+		text_content = context.user_text
+		img_data = context.image
+		if img_data:
+			text_content += "\n\n((The user attached an image to this message - please see the attached image.))"
 			
 		prompt = EMOTION_APPRAISAL_CONTEXT_TEMPLATE.format(
-			memories=memories_str,
-			history=conversation_to_string(messages),
-			beliefs=belief_str,
+			memories=context.memories_str or "None",
+			history=context.history_str,
+			beliefs=context.belief_str,
 			user_input=text_content
 		)
 		prompt_content = prompt
@@ -408,19 +580,18 @@ class EmotionSystem:
 		history = [
 			{"role":"system", "content":sys_prompt},
 			{"role":"user", "content":"[BEGIN MESSAGE HISTORY]"},
-			*messages[:-1],
+			*context.messages[:-1],
 			{"role":"user", "content":"[END MESSAGE HISTORY]"},
 			{"role":"user", "content":prompt_content}
 		]
 		
 		model = MistralLLM()
-		emotion_data = model.generate(
+		return model.generate(
 			history,
 			temperature=0.2,
 			schema=APPRAISAL_SCHEMA,
 			return_json=True
 		)
-		return self._emotions_from_appraisal(emotion_data)
 		
 	def set_emotion(
 		self,
@@ -555,27 +726,25 @@ class EmotionSystem:
 		return emotion
 		
 	def add_emotion(self, emotion):
-		self.emotions.append(emotion)
+		capacity = len(self.emotion_buffer)
+		row = (self.emotion_start + self.num_emotions) % capacity
+		if self.num_emotions < capacity:
+			self.num_emotions += 1
+		else:
+			self.emotion_start = (self.emotion_start + 1) % capacity
+		self.emotion_buffer[row] = (emotion.pleasure, emotion.arousal, emotion.dominance)
 
 	def _tick_emotion_change(self, t):
-		new_emotions = []
-		emotion_center = Emotion()
-		for emotion in self.emotions:
-			half_life = EMOTION_HALF_LIFE
-			emotion_decay = 0.5 ** (t / half_life)
-			emotion *= emotion_decay
-			if emotion.get_intensity() >= 0.01:
-				new_emotions.append(emotion)
-				emotion_center += emotion
-		
-		self.emotions = new_emotions
-		if self.emotions:
-			emotion_center /= len(self.emotions)
-			
-			max_intensity = max(em.get_intensity() for em in self.emotions)
-			total_intensity = sum(em.get_intensity() for em in self.emotions)
-		
-			v = MOOD_CHANGE_VEL * total_intensity / max_intensity
+		emotions = self.emotion_buffer[self._get_emotion_rows()]
+		emotions *= 0.5 ** (t / EMOTION_HALF_LIFE)
+		intensities = np.linalg.norm(emotions, axis=1)
+		keep = intensities >= 0.01
+		emotions = emotions[keep]
+		intensities = intensities[keep]
+		self._set_emotion_array(emotions)
+		if len(emotions):
+			emotion_center = Emotion(*emotions.mean(axis=0).tolist())
+			v = MOOD_CHANGE_VEL * float(intensities.sum() / intensities.max())
 			
 			if emotion_center.distance(self.mood) < 0.005:
 				self.mood = emotion_center.copy()
@@ -593,13 +762,11 @@ class EmotionSystem:
 		return False
 			
 	def get_base_mood(self):
-		now = datetime.now()
+		now = clock.now()
 		hour = now.hour + now.minute / 60 + now.second / 3600
 		
 		# The energy level is likely to be higher during the day and lower at nighttime
-		shift = 2
-		
-		energy_cycle = -math.cos(math.pi * (hour - shift) / 12)
+		energy_cycle = -math.cos(math.pi * (hour - ENERGY_CYCLE_SHIFT) / 12)
 		base_mood = self.base_mood.copy()
 		
 		if energy_cycle > 0:
@@ -616,17 +783,63 @@ class EmotionSystem:
 		base_mood.clamp()
 		return base_mood
 
+	def _get_energy_cycle_integral(self, t, arousal):
+		# The arousal the energy cycle adds to the base mood, integrated over the last t seconds,
+		# weighted by how much each moment still affects the mood at the end.
+		# The cycle is a cosine whose amplitude differs by sign, so it's integrated between zero crossings.
+		start = max(0.0, t - MOOD_MEMORY_HALF_LIVES * MOOD_HALF_LIFE)
+		window_start = clock.now() - timedelta(seconds=t - start)
+		hour = (
+			window_start.hour
+			+ window_start.minute / 60
+			+ (window_start.second + window_start.microsecond / 1e6) / 3600
+		)
+		phase = math.pi * (hour - ENERGY_CYCLE_SHIFT) / 12 - ENERGY_CYCLE_FREQ * start
+		total = 0.0
+		s = start
+		while s < t:
+			angle = ENERGY_CYCLE_FREQ * s + phase
+			next_zero = (math.floor((angle - math.pi / 2) / math.pi) + 1) * math.pi + math.pi / 2
+			end = min(t, s + (next_zero - angle) / ENERGY_CYCLE_FREQ)
+			energy_cycle = -math.cos(ENERGY_CYCLE_FREQ * (s + end) / 2 + phase)
+			amplitude = (1.0 - arousal) if energy_cycle > 0 else (1.0 + arousal)
+			total -= 0.5 * amplitude * integrate_decaying_cos(
+				MOOD_DECAY_RATE, ENERGY_CYCLE_FREQ, phase, s, end, t
+			)
+			s = end
+		return total
+
 	def _tick_mood_decay(self, t):
-		r = 0.5 ** (t / MOOD_HALF_LIFE)
-		
-		self.mood += (self.get_base_mood() - self.mood) * (1 - r)
+		# The mood follows dm = rate * (base(s) - m) ds + sigma * dW, an Ornstein-Uhlenbeck process,
+		# so it can be advanced over any t in one step using its exact transition
+		decay = math.exp(-MOOD_DECAY_RATE * t)
+		base_mood = self.base_mood.copy()
+		base_mood.pleasure += self.relation.friendliness / 100
+		base_mood.dominance += self.relation.dominance / 100
+		energy = self._get_energy_cycle_integral(t, base_mood.arousal)
+		# The arousal stays within [-1, 1] over the cycle, so the clamp in get_base_mood is a constant divisor
+		divisor = max(1.0, abs(base_mood.pleasure), abs(base_mood.dominance))
+		target = base_mood * (1 - decay)
+		target.arousal += energy
+		self.mood = self.mood * decay + target / divisor
+
+		neurotic_mult = 3**self.personality_system.neurotic
+		mood_noise_stdev = 0.006 * neurotic_mult * math.sqrt((1 - decay**2) / (2 * MOOD_DECAY_RATE))
+		self.mood.pleasure += random.gauss(0, mood_noise_stdev)
+		self.mood.arousal += random.gauss(0, mood_noise_stdev)
+		self.mood.dominance += random.gauss(0, mood_noise_stdev)
+		self.mood.clamp()
 
 	def tick(self, dt=None):
+		self._tick(dt)
+		self.recorder.maybe_record(self.last_update, self)
+
+	def _tick(self, dt):
 		if dt is None:
-			dt = time.time() - self.last_update
+			dt = clock.time() - self.last_update
 
 		self.relation.tick(dt)
-		self.last_update = time.time()
+		self.last_update = clock.time()
 		t = dt
 		while t > 0:
 			step = min(t, 1.0)
@@ -636,13 +849,7 @@ class EmotionSystem:
 			t -= step
 		if t <= 0:
 			return
-	
-		substep = max(1, min(t / 10, 30))
-		while t > 0:
-			step = min(t, substep)
-			self._apply_mood_noise(step)
-			self._tick_mood_decay(step)
-			t -= step
+		self._tick_mood_decay(t)
 
 	def _apply_mood_noise(self, t):
 		# Apply some randomness to the mood changes
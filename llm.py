@@ -11,6 +11,19 @@ load_dotenv(".env")
 MISTRAL_API_CHAT_URL = "https://api.mistral.ai/v1/chat/completions"
 MISTRAL_API_EMBED_URL = "https://api.mistral.ai/v1/embeddings"
 
+# Replaces the API when set; see set_backend
+_backend = None
+
+
+def set_backend(backend):
+	"""Routes requests to a backend instead of the Mistral AI API, or back to the API if it is None.
+	The backend needs chat(data) and embed(data) methods, which take and return the API's request and response bodies.
+	Returns the previous backend."""
+	global _backend  # pylint: disable=W0603
+	previous = _backend
+	_backend = backend
+	return previous
+
 
 def mistral_request(messages, model, **kwargs):
 	"""Makes a chat completion request to the Mistral AI API"""
@@ -25,6 +38,8 @@ def mistral_request(messages, model, **kwargs):
 		"messages": messages,
 		**kwargs
 	}
+	if _backend is not None:
+		return _backend.chat(data)
 	max_delay = 20
 	for tries in range(6):
 		response = requests.post(MISTRAL_API_CHAT_URL, json=data, headers=headers, timeout=120)
@@ -59,6 +74,8 @@ def mistral_embed_texts(inputs):
 		"model": "mistral-embed",
 		"input": inputs
 	}
+	if _backend is not None:
+		return _parse_embeddings(inputs, _backend.embed(data))
 	max_delay = 20
 	for tries in range(4):
 		response = requests.post(MISTRAL_API_EMBED_URL, json=data, headers=headers, timeout=30)
@@ -78,7 +95,10 @@ def mistral_embed_texts(inputs):
 		print(response.text)
 		response.raise_for_status()
 
-	embed_res = response.json()
+	return _parse_embeddings(inputs, response.json())
+
+
+def _parse_embeddings(inputs, embed_res):
 	if isinstance(inputs, str):
 		return embed_res["data"][0]["embedding"]
 	return [obj["embedding"] for obj in embed_res["data"]]
@@ -3,12 +3,12 @@
 # Ele serve como ponto de entrada do sistema.
 
 
-import copy
-# Usado para duplicar objetos complexos sem compartilhar referências.
-
 import os
 # Fornece funções para interagir com o sistema operacional (ex.: manipular arquivos, caminhos).
 
+import time
+# Usado para medir o tempo gasto pensando (orçamento de latência).
+
 import traceback
 # Permite capturar e exibir rastros de erro detalhados quando ocorre uma exceção.
 
@@ -24,9 +24,6 @@ import requests
 from collections import deque
 # Estrutura de dados tipo fila dupla (útil para histórico de mensagens).
 
-from datetime import datetime
-# Usado para manipular datas e horários (ex.: registrar interações).
-
 from colored import Fore, Style
 # Biblioteca para imprimir texto colorido no terminal (ex.: destacar emoções ou pensamentos).
 
@@ -34,13 +31,13 @@ from pydantic import BaseModel, Field
 # Usado para validar e estruturar dados (garante que informações sigam um formato correto).
 
 from llm import MistralLLM
+import clock
+# Relógio usado por todos os sistemas (pode ser simulado, ver simulate.py).
 # Importa a classe que conecta o sistema ao modelo de linguagem da Mistral (IA que gera respostas).
 
 from utils import (
     clear_screen,                # Função para limpar a tela do terminal.
-    is_image_url,                # Verifica se um texto é um link de imagem.
-    format_memories_to_string,   # Converte memórias em texto legível.
-    time_since_last_message_string # Calcula quanto tempo passou desde a última mensagem.
+    is_image_url                 # Verifica se um texto é um link de imagem.
 )
 
 from emotion_system import (
@@ -58,9 +55,25 @@ from thought_system import ThoughtSystem
 from const import (
     AI_SYSTEM_PROMPT,  # Texto base que define o comportamento da IA.
     USER_TEMPLATE,     # Estrutura usada para formatar mensagens do usuário.
-    SAVE_PATH          # Caminho onde os dados da IA são salvos (memórias, estado).
+    SAVE_PATH,         # Caminho do arquivo pickle (formato antigo, usado para exportação).
+    THINKING_BUDGET,   # Tempo máximo (segundos) para a IA pensar antes de responder.
+    MOOD_SAMPLE_INTERVAL, # Intervalo padrão entre amostras do histórico de humor.
+    MOOD_EXPORT_PATH,  # Caminho padrão para exportar o histórico de humor.
+    DB_PATH            # Caminho do banco SQLite onde os dados da IA são salvos (memórias, estado).
 )
 
+from storage import SQLiteStore
+# Armazenamento incremental em SQLite (grava apenas o que mudou a cada mensagem).
+
+from stage_executor import StageGraph
+# Executa as etapas de cada mensagem como um grafo de dependências, em paralelo quando possível.
+
+from turn_context import TurnContext
+# Contexto imutável de cada mensagem: os textos dos prompts são montados uma única vez.
+
+from transaction import Transaction
+# Desfaz as mudanças de uma mensagem que falhou, sem copiar a IA inteira.
+
 
 class MessageBuffer:
     # Esta classe funciona como um "histórico de mensagens".
@@ -197,7 +210,7 @@ def suggest_responses(conversation):
 		history_str = "No conversation yet; generate suggested greetings/starters for the human."
 		# Usa uma instrução padrão para pedir ao modelo que sugira cumprimentos iniciais.
 
-	now = datetime.now()
+	now = clock.now()
 	# Pega a data e hora atuais.
 
 	model = MistralLLM("mistral-medium-latest")
@@ -268,6 +281,20 @@ class AIConfig(BaseModel):
     # Define valores padrão para a personalidade da IA.
     # Exemplo: bastante amigável (agreeable=0.93), pouco neurótica (neurotic=-0.05).
 
+    mood_sample_interval: float = Field(default=MOOD_SAMPLE_INTERVAL, gt=0)
+    # Intervalo, em segundos, entre as amostras do histórico de humor (ver /export_mood).
+
+    low_latency: bool = Field(default=False)
+    # Modo de baixa latência: avaliação emocional, pensamentos e resposta numa única chamada ao LLM,
+    # sem pensamento mais profundo. Respostas em JSON continuam usando o modo padrão.
+
+    def __setstate__(self, state):
+        # Configs salvas antes de um campo existir não o têm, então ele recebe o valor padrão.
+        super().__setstate__(state)
+        for name, field in self.__fields__.items():
+            if name not in self.__dict__:
+                object.__setattr__(self, name, field.get_default())
+
 
 class AISystem:
 	# Classe principal que reúne todos os subsistemas da IA:
@@ -310,11 +337,32 @@ class AISystem:
 
 		self.num_messages = 0
 		self.last_message = None
-		self.last_recall_tick = datetime.now()
-		self.last_tick = datetime.now()
+		self.last_recall_tick = clock.now()
+		self.last_tick = clock.now()
 
 		self.buffer = MessageBuffer(20)
 		self.buffer.set_system_prompt(config.system_prompt)
+
+		self.background_turn = None
+		self.background_input = None
+		self.last_turn = None
+		# Turns whose memory couldn't be formed in the background, retried on the next tick
+		self.unremembered = []
+
+	def __getstate__(self):
+		self.wait_for_background_work()
+		state = self.__dict__.copy()
+		del state["background_turn"]
+		del state["background_input"]
+		del state["last_turn"]
+		return state
+
+	def __setstate__(self, state):
+		state.setdefault("unremembered", [])
+		self.__dict__.update(state)
+		self.background_turn = None
+		self.background_input = None
+		self.last_turn = None
 	
 	def set_config(self, config):
 		"""Updates the config"""
@@ -322,6 +370,7 @@ class AISystem:
 		self.memory_system.belief_system.config = config
 		self.thought_system.config = config
 		self.emotion_system.config = config
+		self.emotion_system.recorder.sample_interval = config.mood_sample_interval
 		personality = config.personality
 		self.personality_system = PersonalitySystem(
 			openness=personality.open,
@@ -330,6 +379,7 @@ class AISystem:
 			agreeable=personality.agreeable,
 			neurotic=personality.neurotic
 		)
+		self.personality_system.prefetch_summary()
 		
 
 	def get_message_history(self, include_system_prompt=True):
@@ -339,7 +389,9 @@ class AISystem:
 	def on_startup(self):
 		"""Runs when the AI system is loaded."""
 		self.buffer.flush()
-		self.last_tick = datetime.now()
+		# Only now is it known whether a restored summary is already there
+		self.personality_system.prefetch_summary()
+		self.last_tick = clock.now()
 		self.tick()
 
 	def _image_to_description(self, image_url):
@@ -366,18 +418,31 @@ class AISystem:
 			max_tokens=1024
 		)
 
-	def _input_to_memory(self, user_input, ai_response, attached_image=None):
+	def _input_to_memory(self, user_input, ai_response, attached_image=None, description=None):
 		user_msg = ""
 		if attached_image:
-			description = self._image_to_description(attached_image)
+			if description is None:
+				description = self._image_to_description(attached_image)
 			user_msg += f'<attached_img url="{attached_image}">Description: {description}</attached_img>\n'
 
 		user_msg += user_input
 
 		return f"User: {user_msg}\n\n{self.config.name}: {ai_response}"
 		
-	def _get_format_data(self, content, thought_data, memories):
-		now = datetime.now()
+	def _get_turn_context(self, messages, memories, recalled_memories, personality_summary):
+		return TurnContext(
+			messages,
+			memories,
+			recalled_memories,
+			self.memory_system.get_relevant_beliefs(),
+			personality_summary,
+			self.emotion_system.get_mood_long_description(),
+			self.emotion_system.get_mood_prompt(),
+			self.relation_system.get_string(),
+			self.last_message
+		)
+
+	def _get_format_data(self, context, content, thought_data):
 		user_emotions = thought_data["possible_user_emotions"]
 		user_emotion_list_str =  ", ".join(user_emotions)
 		if user_emotions:
@@ -389,36 +454,47 @@ class AISystem:
 			user_emotion_str = "The user doesn't appear to show any strong emotion."
 
 		thought_str = "\n".join("- " + thought["content"] for thought in thought_data["thoughts"])
-		beliefs = self.memory_system.get_beliefs()
-		if beliefs:
-			belief_str = "\n".join(f"- {belief}" for belief in beliefs)
-		else:
-			belief_str = "None"
 		return {
 			"name": self.config.name,
-			"personality_summary": self.personality_system.get_summary(),
+			"personality_summary": context.personality_summary,
 			"user_input": content,
 			"ai_thoughts": thought_str,
 			"emotion": thought_data["emotion"],
 			"emotion_reason": thought_data["emotion_reason"],
-			"memories": format_memories_to_string(
-				memories,
-				"You don't have any memories of this user yet!"
-			),
-			"curr_date": now.strftime("%a, %m/%d/%Y"),
-			"curr_time": now.strftime("%I:%M %p"),
+			"memories": context.memories_str or "You don't have any memories of this user yet!",
+			"curr_date": context.curr_date,
+			"curr_time": context.curr_time,
 			"user_emotion_str": user_emotion_str,
-			"beliefs": belief_str,
-			"mood_long_desc": self.emotion_system.get_mood_long_description(),
-			"mood_prompt": self.emotion_system.get_mood_prompt(),
-			"last_interaction": time_since_last_message_string(self.last_message)
+			"beliefs": context.belief_str,
+			"mood_long_desc": context.mood_long_desc,
+			"mood_prompt": context.mood_prompt,
+			"last_interaction": context.last_interaction
 		}
 
-	def send_message(self, user_input: str, attached_image=None, return_json=False):
-		"""Sends a message to the AI, and returns the response."""
+	def send_message(self, user_input: str, attached_image=None, return_json=False, thinking_budget=None):
+		"""Sends a message to the AI, and returns the response.
+		Thinking stops early if it would go on for more than thinking_budget seconds after the message is sent.
+		If anything fails before the response is ready, the AI system is rolled back to how it was before the message."""
+		deadline = time.perf_counter() + (THINKING_BUDGET if thinking_budget is None else thinking_budget)
+		# The previous turn must be finished for the snapshot to be consistent
+		self.wait_for_background_work()
+		transaction = Transaction(self)
+		self.memory_system.begin_turn()
+		try:
+			response = self._send_message(user_input, attached_image, return_json, deadline)
+		except Exception:
+			# Every stage leading to the response has finished by now, so nothing changes after the rollback
+			transaction.rollback()
+			raise
+		finally:
+			self.memory_system.end_turn()
+		transaction.commit()
+		return response
+
+	def _send_message(self, user_input, attached_image, return_json, deadline):
 		self.tick()
 		
-		self.last_recall_tick = datetime.now()
+		self.last_recall_tick = clock.now()
 		self.buffer.set_system_prompt(self.config.system_prompt)
 
 		content = user_input
@@ -435,31 +511,77 @@ class AISystem:
 			]
 		self.buffer.add_message("user", content)
 
-		history = self.get_message_history()
-
-		memories, recalled_memories = self.memory_system.recall_memories(history)
-		
-		thought_data = self.thought_system.think(
-			self.get_message_history(False),
-			memories,
-			recalled_memories,
-			self.last_message
+		messages = self.get_message_history(False)
+
+		# Stages with no dependency between them run concurrently.
+		# Remembering the turn only runs after the reply has been returned, and is joined on the next tick.
+		turn = StageGraph()
+		turn.add("summary", self.personality_system.get_summary)
+		turn.add("recall", lambda: self.memory_system.recall_memories(messages))
+		turn.add("image_description", lambda: attached_image and self._image_to_description(attached_image))
+		# Appraisal, thinking and the response all build their prompts from this one snapshot
+		turn.add(
+			"context",
+			lambda summary, recall: self._get_turn_context(messages, *recall, summary),
+			deps=("summary", "recall")
+		)
+		if self.config.low_latency and not return_json:
+			# Appraisal, thoughts and the response all come from one completion
+			turn.add("think", self.thought_system.think_and_respond, deps=("context",))
+			turn.add("response", lambda think: think["response"], deps=("think",))
+		else:
+			turn.add(
+				"think",
+				lambda context: self.thought_system.think(context, deadline=deadline),
+				deps=("context",)
+			)
+			turn.add(
+				"response",
+				lambda context, think: self._generate_response(context, think, return_json),
+				deps=("context", "think")
+			)
+		turn.add(
+			"remember",
+			lambda image_description, think, response: self.memory_system.remember(
+				self._input_to_memory(user_input, response, attached_image, image_description),
+				emotion=think["emotion_obj"]
+			),
+			deps=("image_description", "think", "response"),
+			capture_output=True
 		)
+		# What the deferred stages print is held until the turn is joined, so it doesn't interleave with the prompt
+		turn.add("tick", lambda remember: self._tick(), deps=("remember",), capture_output=True)
+		self.last_turn = turn
+		self.background_turn = turn
+		self.background_input = (user_input, attached_image)
+		try:
+			response = turn.run("response")
+		except Exception:
+			# The stages after the reply can't run without it
+			self.background_turn = None
+			raise
 
-		content = history[-1]["content"]
+		self.last_message = clock.now()
+		new_response = response
+		if return_json:
+			response = json.dumps(new_response, indent=2)
+		self.buffer.add_message("assistant", new_response)
+		return response
 
-		img_data = None
-		if isinstance(content, list):
-			assert len(content) == 2
-			assert content[0]["type"] == "text"
-			assert content[1]["type"] == "image_url"
-			text_content = content[0]["text"] + "\n\n((The user attached an image to this message))"
-			img_data = content[1]
-		else:
-			text_content = content
+	def _generate_response(self, context, thought_data, return_json):
+		# Thinking may have changed the mood, and the response should reflect what was just felt
+		context = context.with_mood(
+			self.emotion_system.get_mood_long_description(),
+			self.emotion_system.get_mood_prompt(),
+			self.relation_system.get_string()
+		)
+		text_content = context.user_text
+		img_data = context.image
+		if img_data:
+			text_content += "\n\n((The user attached an image to this message))"
 
 		prompt_content = USER_TEMPLATE.format(
-			**self._get_format_data(text_content, thought_data, memories)
+			**self._get_format_data(context, text_content, thought_data)
 		)
 		if img_data:
 			prompt_content = [
@@ -467,9 +589,13 @@ class AISystem:
 				{"type":"text", "text":prompt_content}
 			]
 
-		history[-1]["content"] = prompt_content
+		history = [
+			{"role":"system", "content":self.config.system_prompt},
+			*context.messages[:-1],
+			{"role":"user", "content":prompt_content}
+		]
 		
-		response = self.model.generate(
+		return self.model.generate(
 			history,
 			temperature=1.0,
 			presence_penalty=1.0,
@@ -477,17 +603,80 @@ class AISystem:
 			return_json=return_json
 		)
 
-		self.memory_system.remember(
-			self._input_to_memory(user_input, response, attached_image),
-			emotion=thought_data["emotion_obj"]
-		)
-		self.last_message = datetime.now()
-		self.tick()
-		new_response = response
-		if return_json:
-			response = json.dumps(new_response, indent=2)
-		self.buffer.add_message("assistant", new_response)
-		return response
+	def wait_for_background_work(self):
+		"""Waits for the previous turn's remaining stages, such as remembering it, to finish"""
+		turn = self.background_turn
+		if turn is None:
+			return
+		self.background_turn = None
+		try:
+			turn.wait()
+		except Exception as e:  # pylint: disable=W0718
+			# The reply was already given, so the turn is kept to be remembered on the next tick instead
+			print(turn.get_output(), end="")
+			traceback.print_exception(type(e), e, e.__traceback__)
+			if turn.exception("remember") is not None:
+				user_input, attached_image = self.background_input
+				description = None
+				if turn.exception("image_description") is None:
+					description = turn.result("image_description")
+				self.unremembered = self.unremembered + [{
+					"user_input": user_input,
+					"response": turn.result("response"),
+					"attached_image": attached_image,
+					"description": description,
+					"emotion": turn.result("think")["emotion_obj"]
+				}]
+				print("The last message couldn't be remembered yet, so it will be retried on the next tick.")
+		else:
+			print(turn.get_output(), end="")
+
+	def _retry_unremembered(self):
+		# Remembers the turns that failed to be remembered, stopping at the first one that fails again
+		for i, turn_input in enumerate(self.unremembered):
+			try:
+				self.memory_system.remember(
+					self._input_to_memory(
+						turn_input["user_input"],
+						turn_input["response"],
+						turn_input["attached_image"],
+						turn_input["description"]
+					),
+					emotion=turn_input["emotion"]
+				)
+			except Exception as e:  # pylint: disable=W0718
+				traceback.print_exception(type(e), e, e.__traceback__)
+				self.unremembered = self.unremembered[i:]
+				return
+		self.unremembered = []
+
+	def get_turn_report(self):
+		"""Returns a description of the last turn's stage timings and critical path, or None"""
+		if self.last_turn is None:
+			return None
+		report = self.last_turn.format_report("response")
+		thinking = self.thought_system.last_thinking
+		if thinking:
+			report += (
+				f"\nThinking: {thinking['steps']} extra step(s) in {thinking['seconds']*1000:.0f} ms, "
+				f"stopped by {thinking['stop_reason'].replace('_', ' ')}"
+			)
+		stats = self.thought_system.generation_stats.get_summary()
+		if stats:
+			report += (
+				f"\nThought generation ({self.thought_system.retry_strategy} retries): "
+				f"{stats['success_rate']:.0%} success over {stats['attempts']} turn(s), "
+				f"{stats['calls_per_attempt']:.2f} calls per turn, "
+				f"{stats['latency_mean']*1000:.0f} ms mean, {stats['latency_p95']*1000:.0f} ms p95"
+			)
+		stats = self.emotion_system.appraisal_stats.get_summary()
+		if stats:
+			report += (
+				f"\nAppraisal: {stats['escalation_rate']:.0%} of {stats['appraisals']} message(s) escalated to the LLM"
+			)
+			if stats["agreement"] is not None:
+				report += f", local tier agreed on {stats['agreement']:.0%} of {stats['compared']} checked"
+		return report
 
 	def set_thought_visibility(self, shown: bool):
 		"""Sets the flag for whether or not to show the AI's internal thoughts."""
@@ -527,10 +716,21 @@ class AISystem:
 	def consolidate_memories(self):
 		"""Consolidates short-term memories into long-term."""
 		self.memory_system.consolidate_memories()	
+
+	def flush(self, timeout=None):
+		"""Waits for background work, such as forming beliefs, to finish. Returns False on timeout."""
+		self.wait_for_background_work()
+		return self.memory_system.belief_system.flush(timeout)
 	
 	def tick(self):
 		"""Runs a tick to update the AI's systems"""
-		now = datetime.now()
+		self.wait_for_background_work()
+		self._tick()
+
+	def _tick(self):
+		if self.unremembered:
+			self._retry_unremembered()
+		now = clock.now()
 		delta = (now - self.last_tick).total_seconds()
 		self.emotion_system.tick()
 		if self.thought_system.can_reflect():
@@ -544,24 +744,40 @@ class AISystem:
 		self.last_tick = now
 		
 	def save(self, path):
-		"""Saves the AI system to the path"""
+		"""Exports the whole AI system to a pickle file at the path"""
 		with open(path, "wb") as file:
 			pickle.dump(self, file)
 	
 	@staticmethod
 	def load(path):
-		"""Loads the AI system from the path. Returns None if it doesn't exist."""
+		"""Loads the AI system from a pickle file at the path. Returns None if it doesn't exist."""
 		if os.path.exists(path):
 			print("Loading Amorelia...")
 			with open(path, "rb") as file:
 				return pickle.load(file)
 		else:
 			return None
+
+	@classmethod
+	def load_from_store(cls, store):
+		"""Loads the AI system from a SQLiteStore. Returns None if nothing has been saved."""
+		config = store.get_state("config")
+		if config is None:
+			return None
+		print("Loading Amorelia...")
+		ai_system = cls(AIConfig.parse_obj(config))
+		store.restore(ai_system)
+		return ai_system
 			
 	@classmethod
-	def load_or_create(cls, path):
-		"""Loads the AI system from the path, or creates it if it doesn't exist."""
-		ai_system = cls.load(path)
+	def load_or_create(cls, store):
+		"""Loads the AI system from the store, or creates it if it doesn't exist.
+		A save file from the pickle format is imported into the store if one exists."""
+		ai_system = cls.load_from_store(store)
+		if ai_system is None:
+			ai_system = cls.load(SAVE_PATH)
+			if ai_system is not None:
+				store.save(ai_system)
 		is_new = ai_system is None
 		if is_new:
 			print("Initializing Amorelia...")
@@ -635,7 +851,8 @@ def command_parse(string):
 def main():
 	"""The main method"""
 	attached_image = None
-	ai = AISystem.load_or_create(SAVE_PATH)
+	store = SQLiteStore(DB_PATH)
+	ai = AISystem.load_or_create(store)
 
 	# >>> Aqui começa nossa história <<<
 	print("Inicializando Caminhos do Vilarejo...!")
@@ -661,9 +878,17 @@ def main():
 		ai.emotion_system.print_mood()
 		if attached_image:
 			print(f"Attached image: {attached_image}")
-		msg = input("User: ").strip()
+		try:
+			msg = input("User: ").strip()
+		except (KeyboardInterrupt, EOFError):
+			# Anything still queued is saved and picked up on the next start
+			print()
+			ai.flush(timeout=30)
+			store.save(ai)
+			store.close()
+			break
 		if not msg:
-			ai.save(SAVE_PATH)
+			store.save(ai)
 			continue
 			
 		if msg.startswith("/"):
@@ -729,17 +954,22 @@ def main():
 				for response in possible_responses:
 					print("- " + response)
 			elif command in ["wipe", "reset"]:
-				if os.path.exists(SAVE_PATH):
+				if store.get_state("config") is not None or os.path.exists(SAVE_PATH):
 					choice = input(
 						"Are you sure you want to erase saved data and memories for this AI? "
 						"Type 'yes' to erase data, or anything else to cancel: "
 					)
 					if choice.strip().lower() == "yes":
-						os.remove(SAVE_PATH)
+						store.clear()
+						if os.path.exists(SAVE_PATH):
+							os.remove(SAVE_PATH)
 						input("The AI has been reset. Press enter to continue.")
 						clear_screen()
 						ai = AISystem()
 						ai.on_startup()
+			elif command == "timings":
+				report = ai.get_turn_report()
+				print(report or "No messages have been sent yet")
 			elif command == "beliefs":
 				beliefs = ai.get_beliefs()
 				if beliefs:
@@ -751,19 +981,34 @@ def main():
 			elif command == "configupdate":
 				new_config = AIConfig()
 				ai.set_config(new_config)
-				ai.save(SAVE_PATH)
+				store.save(ai)
 				print("Config updated and saved!")
+			elif command == "export" and len(args) <= 1:
+				path = args[0] if args else SAVE_PATH
+				if not isinstance(path, str):
+					continue
+				ai.save(path)
+				print(f"Exported to '{path}'")
+			elif command == "export_mood" and len(args) <= 1:
+				path = args[0] if args else MOOD_EXPORT_PATH
+				if not isinstance(path, str):
+					continue
+				recorder = ai.emotion_system.recorder
+				if path.endswith(".csv"):
+					recorder.export_csv(path)
+				else:
+					recorder.export_binary(path)
+				print(f"Exported mood history to '{path}'")
 			else:
 				print(f"Invalid command '/{command}'")
 			continue
 
 		print()
 
-		backup_ai = copy.deepcopy(ai)
 		try:
+			# A failed message is rolled back by send_message itself
 			message = ai.send_message(msg, attached_image=attached_image)
 		except Exception as e:  # pylint: disable=W0718,C0103
-			ai = backup_ai  # Restore in case something changed before the error
 			traceback.print_exception(type(e), e, e.__traceback__)
 			print()
 			print(
@@ -773,7 +1018,7 @@ def main():
 			
 		else:
 			print(f"{ai.config.name}: " + message)
-			ai.save(SAVE_PATH)
+			store.save(ai)
 			attached_image = None
 
 
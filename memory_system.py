@@ -1,14 +1,19 @@
 import uuid
+import time
+import bisect
+import queue
 import random
 import math
+import threading
 from collections import deque
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from rank_bm25 import BM25Okapi
 
 from const import * 
 from llm import MistralLLM, mistral_embed_texts
+import clock
 from utils import (
 	normalize_text,
 	get_approx_time_ago_str,
@@ -17,6 +22,8 @@ from utils import (
 from emotion_system import Emotion
 from belief_system import BeliefSystem
 
+_importance_executor = ThreadPoolExecutor(max_workers=REFLECTION_CONCURRENCY, thread_name_prefix="importance")
+
 
 IMPORTANCE_PROMPT = """Your task is to rate the importance of the given memory from 1 to 10.
 
@@ -46,6 +53,11 @@ def get_importance(memory):
 		score = 3
 	
 	return max(1, min(score, 10))
+
+
+def get_importances(memories):
+	"""Rates the importance of several memories, making the calls concurrently"""
+	return list(_importance_executor.map(get_importance, memories))
 	
 	
 def cosine_similarity(x, y):
@@ -59,12 +71,14 @@ def cosine_similarity(x, y):
 	return np.squeeze(sim)
 
 
+_rng = np.random.default_rng()
+
 
 class Memory:
 	"""Represents a stored memory"""
 		
 	def __init__(self, content, strength=1.0, emotion=None):
-		now = datetime.now()
+		now = clock.now()
 		self.timestamp = now
 		self.last_accessed = now
 		self.content = content
@@ -76,7 +90,7 @@ class Memory:
 	def get_recency_factor(self, from_creation=False):
 		"""Returns the recency value of a memory, based on time and strength"""
 		t = self.timestamp if from_creation else self.last_accessed
-		seconds = (datetime.now() - t).total_seconds()
+		seconds = (clock.now() - t).total_seconds()
 		days = seconds / 86400
 		return math.exp(-days / (self.strength * MEMORY_DECAY_TIME_MULT))
 
@@ -90,11 +104,11 @@ class Memory:
 	def reinforce(self):
 		"""Reinforces the memory when it is recalled"""
 		self.strength += 1
-		self.last_accessed = datetime.now()
+		self.last_accessed = clock.now()
 
 	def format_memory(self):
 		"""Formats the memory as a string"""
-		timedelta = datetime.now() - self.timestamp
+		timedelta = clock.now() - self.timestamp
 		time_ago_str = get_approx_time_ago_str(timedelta)
 		
 		time_format = self.timestamp.strftime(f"%a, %m/%d/%Y, %I:%M %p")
@@ -108,6 +122,201 @@ class Memory:
 			self.embedding = np.array(self.embedding)
 
 
+def recency_from_arrays(times, strengths):
+	"""Vectorized version of Memory.get_recency_factor, given POSIX timestamps and strengths"""
+	days = (clock.time() - times) / 86400
+	return np.exp(-days / (strengths * MEMORY_DECAY_TIME_MULT))
+
+
+def get_recency_factors(memories, from_creation=False):
+	"""Returns the recency values of a list of memories as an array"""
+	times = np.fromiter(
+		((mem.timestamp if from_creation else mem.last_accessed).timestamp() for mem in memories),
+		dtype=float,
+		count=len(memories)
+	)
+	strengths = np.fromiter((mem.strength for mem in memories), dtype=float, count=len(memories))
+	return recency_from_arrays(times, strengths)
+
+
+def weighted_sample(weights, k, rng=None):
+	"""Returns k indices sampled without replacement, with probability proportional to the weights.
+	Uses the Gumbel top-k trick, so it needs a single pass over the weights."""
+	if rng is None:
+		rng = _rng
+	weights = np.asarray(weights, dtype=float)
+	k = min(k, len(weights))
+	if k <= 0:
+		return np.array([], dtype=int)
+	with np.errstate(divide="ignore"):
+		keys = np.log(weights) + rng.gumbel(size=len(weights))
+	if k < len(keys):
+		idx = np.argpartition(keys, -k)[-k:]
+	else:
+		idx = np.arange(len(keys))
+	return idx[np.argsort(keys[idx])[::-1]]
+
+
+def encode_memories(memories):
+	"""Embeds all memories that don't have an embedding yet in a single request"""
+	memories = [mem for mem in memories if mem.embedding is None]
+	if not memories:
+		return
+	embeddings = mistral_embed_texts([mem.content for mem in memories])
+	for memory, embed in zip(memories, embeddings):
+		memory.encode(embed)
+
+
+class TimeIndex:
+	"""Keeps memories ordered by creation time, for time range queries"""
+
+	def __init__(self):
+		self.keys = []
+		self.memories = {}
+
+	def __len__(self):
+		return len(self.keys)
+
+	def add(self, memory):
+		"""Adds a memory to the index"""
+		if memory.id in self.memories:
+			return
+		bisect.insort(self.keys, (memory.timestamp.timestamp(), memory.id))
+		self.memories[memory.id] = memory
+
+	def add_many(self, memories):
+		"""Adds a list of memories to the index, with a single sort for large batches"""
+		memories = [mem for mem in memories if mem.id not in self.memories]
+		if len(memories) < 16:
+			for mem in memories:
+				self.add(mem)
+			return
+		self.keys.extend((mem.timestamp.timestamp(), mem.id) for mem in memories)
+		self.keys.sort()
+		self.memories.update((mem.id, mem) for mem in memories)
+
+	def remove(self, memory):
+		"""Removes a memory from the index"""
+		if self.memories.pop(memory.id, None) is None:
+			return
+		key = (memory.timestamp.timestamp(), memory.id)
+		i = bisect.bisect_left(self.keys, key)
+		if i < len(self.keys) and self.keys[i] == key:
+			del self.keys[i]
+
+	def clear(self):
+		"""Removes all memories from the index"""
+		self.keys.clear()
+		self.memories.clear()
+
+	def get_range(self, start=None, end=None):
+		"""Returns the memories created in [start, end), ordered by creation time.
+		Either bound can be None to leave that side open."""
+		lo = 0 if start is None else bisect.bisect_left(self.keys, (start.timestamp(),))
+		hi = len(self.keys) if end is None else bisect.bisect_left(self.keys, (end.timestamp(),))
+		return [self.memories[memory_id] for _, memory_id in self.keys[lo:hi]]
+
+
+class RetrievalContext:
+	"""Caches query embeddings and retrieval results for the duration of a turn"""
+
+	def __init__(self):
+		self.embeddings = {}
+		self.results = {}
+		self.query = None  # What the turn's memories were recalled with
+
+	def prefetch(self, queries):
+		"""Embeds any queries that haven't been embedded yet in a single batch"""
+		missing = [q for q in dict.fromkeys(queries) if q not in self.embeddings]
+		if not missing:
+			return
+		embeddings = mistral_embed_texts(missing)
+		for query, embed in zip(missing, embeddings):
+			self.embeddings[query] = np.array(embed)
+
+	def embed(self, query):
+		"""Returns the embedding of the query, embedding it only on first use"""
+		self.prefetch([query])
+		return self.embeddings[query]
+
+	def get_embedding(self, query):
+		"""Returns the embedding of the query if it has already been embedded, or None"""
+		return self.embeddings.get(query)
+
+	def get_results(self, key):
+		"""Returns the cached retrieval results for the key, or None"""
+		return self.results.get(key)
+
+	def set_results(self, key, memories):
+		"""Caches retrieval results for the key"""
+		self.results[key] = list(memories)
+
+
+class LSHBucket:
+	"""A bucket of memories kept in contiguous arrays, where each memory occupies a slot.
+	Deleting moves the last memory into the freed slot, so it takes constant time."""
+	min_capacity = 16
+
+	def __init__(self, embed_size):
+		self.memories = []
+		# Single precision halves the cost of keeping a second copy of each embedding
+		self.embeddings = np.empty((0, embed_size), dtype=np.float32)
+		self.norms = np.empty(0)
+		# Memories aren't reinforced while they're in long-term memory, so these never go stale
+		self.times = np.empty(0)
+		self.strengths = np.empty(0)
+
+	def __len__(self):
+		return len(self.memories)
+
+	def __iter__(self):
+		return iter(self.memories)
+
+	def _resize(self, capacity):
+		size = len(self.memories)
+		for name in ("embeddings", "norms", "times", "strengths"):
+			old = getattr(self, name)
+			new = np.empty((capacity, *old.shape[1:]), dtype=old.dtype)
+			new[:size] = old[:size]
+			setattr(self, name, new)
+
+	def add_memories(self, memories):
+		"""Appends memories to the bucket. Returns the slot of the first one."""
+		start = len(self.memories)
+		end = start + len(memories)
+		if end > len(self.times):
+			self._resize(max(self.min_capacity, 2 * len(self.times), end))
+		for i in range(0, len(memories), 4096):  # Bounds the size of the stacked matrix
+			chunk = memories[i:i+4096]
+			vecs = np.stack([mem.embedding for mem in chunk])
+			self.embeddings[start+i:start+i+len(chunk)] = vecs
+			self.norms[start+i:start+i+len(chunk)] = np.linalg.norm(vecs, axis=1)
+		self.times[start:end] = [mem.last_accessed.timestamp() for mem in memories]
+		self.strengths[start:end] = [mem.strength for mem in memories]
+		self.memories.extend(memories)
+		return start
+
+	def remove(self, slot):
+		"""Removes the memory in the slot. Returns the memory that was moved into it, if any."""
+		last = len(self.memories) - 1
+		moved = None
+		if slot != last:
+			moved = self.memories[last]
+			self.memories[slot] = moved
+			for arr in (self.embeddings, self.norms, self.times, self.strengths):
+				arr[slot] = arr[last]
+		self.memories.pop()
+		# Compact once the bucket has shrunk well below its capacity
+		if len(self.times) > self.min_capacity and last < len(self.times) // 4:
+			self._resize(max(self.min_capacity, len(self.times) // 2))
+		return moved
+
+	def get_recency_factors(self):
+		"""Returns the recency values of the memories in slot order"""
+		size = len(self.memories)
+		return recency_from_arrays(self.times[:size], self.strengths[:size])
+
+
 class LSHMemory:
 	"""Stores long-term memories using locality-sensitive hashing"""
 	
@@ -118,15 +327,48 @@ class LSHMemory:
 		rng = np.random.default_rng(seed=42)
 		self.rand = rng.normal(size=(embed_size, nbits))
 		self.count = 0
+		self.version = 0
+		self.time_index = TimeIndex()
+
+	def __setstate__(self, state):
+		# Older saves lack these, and rebuilding the index below needs them
+		state.setdefault("version", 0)
+		state.setdefault("time_index", None)
+		self.__dict__.update(state)
+		if any(isinstance(bucket, list) for bucket in self.table.values()):
+			# Saved before buckets had slots, so rebuild the index
+			memories = [mem for bucket in self.table.values() for mem in bucket]
+			for name in ("slot_memories", "slot_positions", "slot_times", "slot_strengths"):
+				self.__dict__.pop(name, None)
+			self.table = {}
+			self.memory_ids = {}
+			self.count = 0
+			self.time_index = TimeIndex()
+			self.add_memories(memories)
+		elif self.time_index is None:
+			self.time_index = TimeIndex()
+			for memory in self.get_memories():
+				self.time_index.add(memory)
+
+	def _get_bucket(self, hash_ind):
+		bucket = self.table.get(hash_ind)
+		if bucket is None:
+			bucket = self.table[hash_ind] = LSHBucket(self.rand.shape[0])
+		return bucket
 		
+	def _get_hashes(self, vecs):
+		"""Hashes each row of a matrix of vectors. The first bit is the most significant."""
+		bits = (np.asarray(vecs) @ self.rand) > 0
+		packed = np.packbits(bits, axis=1).astype(np.uint64)
+		hashes = np.zeros(len(packed), dtype=np.uint64)
+		for column in packed.T:
+			hashes = (hashes << np.uint64(8)) | column
+		# packbits pads each row with zero bits up to a whole byte
+		hashes >>= np.uint64(8 * packed.shape[1] - bits.shape[1])
+		return hashes.tolist()
+
 	def _get_hash(self, vec):
-		proj = np.dot(vec, self.rand)
-		bits = (proj > 0).astype(int)
-		hash_ind = 0
-		for bit in bits:
-			hash_ind <<= 1
-			hash_ind |= bit
-		return hash_ind
+		return self._get_hashes(np.asarray(vec)[np.newaxis])[0]
 		
 	#def _cluster_memories(self, bucket):
 #		threshold = 0.95
@@ -175,44 +417,71 @@ class LSHMemory:
 #
 	def add_memory(self, memory):
 		"""Adds a memory"""
-		self.count += 1
-		vec = memory.embedding
-		hash_ind = self._get_hash(vec)
-		self.table.setdefault(hash_ind, [])
-		self.table[hash_ind].append(memory)
-		self.memory_ids[memory.id] = (memory, hash_ind)
+		self.add_memories([memory])
 	
+	def add_memories(self, memories):
+		"""Adds a list of memories, hashing them together and filling each bucket in one step"""
+		memories = [mem for mem in memories if mem.id not in self.memory_ids]
+		if not memories:
+			return
+		hashes = []
+		for i in range(0, len(memories), 4096):  # Bounds the size of the stacked matrix
+			hashes.extend(self._get_hashes(np.stack([mem.embedding for mem in memories[i:i+4096]])))
+		groups = {}
+		for memory, hash_ind in zip(memories, hashes):
+			groups.setdefault(hash_ind, []).append(memory)
+		for hash_ind, group in groups.items():
+			start = self._get_bucket(hash_ind).add_memories(group)
+			self.memory_ids.update(
+				(mem.id, (mem, hash_ind, start + i)) for i, mem in enumerate(group)
+			)
+		self.time_index.add_many(memories)
+		self.count += len(memories)
+		self.version += 1
+
 	def delete_memory(self, memory):
 		"""Removes a memory"""
 		if memory.id not in self.memory_ids:
 			return
-		_, hash_ind = self.memory_ids[memory.id]
-		bucket = self.table[hash_ind]
-		for i, mem in enumerate(bucket):
-			if mem.id == memory.id:
-				del bucket[i]
-				del self.memory_ids[memory.id]
-				self.count -= 1
-				break
+		_, hash_ind, slot = self.memory_ids.pop(memory.id)
+		moved = self.table[hash_ind].remove(slot)
+		if moved is not None:
+			self.memory_ids[moved.id] = (moved, hash_ind, slot)
+		self.time_index.remove(memory)
+		self.count -= 1
+		self.version += 1
 	
-	def retrieve(self, query, k, remove=False):
-		"""Gets the top K most relevant memories"""
+	def retrieve(self, query, k, remove=False, context=None, start=None, end=None):
+		"""Gets the top K most relevant memories.
+		If start or end is given, only memories created in that time range are considered."""
 		if not self.count:
 			return []
-		query_vec = mistral_embed_texts(query)
-		hash_ind = self._get_hash(query_vec)
+		if context is not None:
+			query_vec = context.embed(query)
+		else:
+			query_vec = np.array(mistral_embed_texts(query))
 
-		memories = self.table.get(hash_ind, [])
-		if not memories:
-			return []
+		query_norm = np.linalg.norm(query_vec)
+		if start is None and end is None:
+			bucket = self.table.get(self._get_hash(query_vec))
+			if not bucket:
+				return []
+			size = len(bucket)
+			memories = bucket.memories
+			sim_vals = bucket.embeddings[:size] @ query_vec
+			sim_vals /= query_norm * bucket.norms[:size]
+			recency_vals = bucket.get_recency_factors()
+		else:
+			# Time ranges are scored exhaustively, since relevant memories may be in any bucket
+			memories = self.time_index.get_range(start, end)
+			if not memories:
+				return []
+			result_vecs = np.stack([mem.embedding for mem in memories])
+			sim_vals = result_vecs @ query_vec
+			sim_vals /= query_norm * np.linalg.norm(result_vecs, axis=1)
+			recency_vals = get_recency_factors(memories)
 
 		k = min(k, len(memories))
-		result_vecs = np.stack([mem.embedding for mem in memories])
-		sim_vals = query_vec @ result_vecs.T
-		sim_vals /= np.linalg.norm(query_vec) * np.linalg.norm(result_vecs, axis=1)
-	
-		recency_vals = np.array([mem.get_recency_factor() for mem in memories])
-	
 		scores = sim_vals + 0.5 * recency_vals
 	
 		idx = np.argpartition(scores, -k)[-k:]
@@ -222,6 +491,32 @@ class LSHMemory:
 			for mem in retrieved:
 				self.delete_memory(mem)
 		return retrieved
+
+	def retrieve_many(self, query_vecs, k):
+		"""Gets the top K most relevant memories for each row of a matrix of query embeddings.
+		Queries that hash to the same bucket are scored against it with a single matrix product."""
+		query_vecs = np.asarray(query_vecs)
+		results = [[] for _ in range(len(query_vecs))]
+		if not self.count or not len(query_vecs):
+			return results
+		groups = {}
+		for i, hash_ind in enumerate(self._get_hashes(query_vecs)):
+			groups.setdefault(hash_ind, []).append(i)
+		for hash_ind, rows in groups.items():
+			bucket = self.table.get(hash_ind)
+			if not bucket:
+				continue
+			size = len(bucket)
+			vecs = query_vecs[rows]
+			sim_vals = bucket.embeddings[:size] @ vecs.T
+			sim_vals /= np.outer(bucket.norms[:size], np.linalg.norm(vecs, axis=1))
+			scores = sim_vals + 0.5 * bucket.get_recency_factors()[:, np.newaxis]
+			top_k = min(k, size)
+			idx = np.argpartition(scores, -top_k, axis=0)[-top_k:]
+			for column, row in enumerate(rows):
+				order = idx[np.argsort(scores[idx[:, column], column])[::-1], column]
+				results[row] = [bucket.memories[i] for i in order]
+		return results
 	
 	def get_memories(self):
 		"""Gets all memories as a list"""
@@ -230,27 +525,17 @@ class LSHMemory:
 			memories.extend(bucket)
 		return memories
 	
-	def recall_random(self, remove=False):
+	def recall_random(self, remove=False, k=5):
 		"""Recalls a random subset of memories, weighted by memory strength"""
+		buckets = [bucket for bucket in self.table.values() if len(bucket)]
+		if not buckets:
+			return []
+		weights = np.concatenate([bucket.get_recency_factors() for bucket in buckets])
+		offsets = np.cumsum([0] + [len(bucket) for bucket in buckets])
 		recalled = []
-		weights = []
-		for bucket in self.table.values():
-			if not bucket:
-				continue
-			sample_size = min(6, len(bucket))
-			sample = random.sample(bucket, sample_size)
-			recalled.extend(sample)
-			weights.extend([mem.get_recency_factor() for mem in sample])
-	
-		if len(recalled) > 5:
-			new_recalled = []
-			for _ in range(5):
-				choice = random.choices(recalled, weights)[0]
-				ind = recalled.index(choice)
-				new_recalled.append(recalled.pop(ind))
-				weights.pop(ind)
-	
-			recalled = new_recalled
+		for i in weighted_sample(weights, k):
+			bucket_ind = np.searchsorted(offsets, i, side="right") - 1
+			recalled.append(buckets[bucket_ind].memories[i - offsets[bucket_ind]])
 
 		if remove:
 			for mem in recalled:
@@ -265,6 +550,14 @@ class ShortTermMemory:
 
 	def __init__(self):
 		self.memories = deque()
+		self.time_index = TimeIndex()
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		if "time_index" not in state:
+			self.time_index = TimeIndex()
+			for memory in self.memories:
+				self.time_index.add(memory)
 
 	def add_memory(self, memory):
 		"""Adds a new memory"""
@@ -274,6 +567,7 @@ class ShortTermMemory:
 				break
 		else:
 			self.memories.append(memory)
+			self.time_index.add(memory)
 
 	def _move_to_end(self, memory):
 		if memory in self.memories:
@@ -289,17 +583,24 @@ class ShortTermMemory:
 		"""Flushes out and returns memories that have exceeded the capacity"""
 		old_memories = []
 		while len(self.memories) > self.capacity:
-			old_memories.append(self.memories.popleft())
+			memory = self.memories.popleft()
+			self.time_index.remove(memory)
+			old_memories.append(memory)
 		return old_memories
 
 	def clear_memories(self):
 		"""Clears all short-term memories"""
 		self.memories.clear()
+		self.time_index.clear()
 
 	def get_memories(self):
 		"""Returns a list of all short-term memories"""
 		return list(self.memories)
 
+	def get_memories_between(self, start=None, end=None):
+		"""Returns the short-term memories created in [start, end), oldest first"""
+		return self.time_index.get_range(start, end)
+
 	def rehearse(self, query):
 		"""Strengthens any similar memories to the query"""
 		if not self.memories:
@@ -322,42 +623,204 @@ class ShortTermMemory:
 			self._move_to_end(mem)
 
 		
+class ConsolidationWorker:
+	"""Embeds memories on a background thread, a small batch at a time"""
+	trickle_delay = 0.5
+
+	def __init__(self, max_queue_size=CONSOLIDATION_QUEUE_SIZE):
+		self.queue = queue.Queue(maxsize=max_queue_size)
+		self.thread = None
+
+	def submit(self, memories):
+		"""Queues a batch of memories to be embedded. Returns False if the queue is full."""
+		if self.thread is None or not self.thread.is_alive():
+			self.thread = threading.Thread(target=self._run, daemon=True)
+			self.thread.start()
+		try:
+			self.queue.put_nowait(memories)
+		except queue.Full:
+			return False
+		return True
+
+	def is_idle(self):
+		"""Returns whether every submitted batch has been processed"""
+		return not self.queue.unfinished_tasks
+
+	def _run(self):
+		while True:
+			memories = self.queue.get()
+			try:
+				encode_memories(memories)
+			except Exception:  # pylint: disable=W0718
+				# Memories are left unencoded and are resubmitted once the worker is idle
+				pass
+			finally:
+				self.queue.task_done()
+			time.sleep(self.trickle_delay)
+
+
 class LongTermMemory:
 	"""Long-term memory which stores memories long-term"""
 
-	def __init__(self):
-		self.lsh = LSHMemory(LSH_NUM_BITS, LSH_VEC_DIM)
+	def __init__(self, backend=None):
+		# Any index with the same interface as LSHMemory can be used as the backend
+		self.lsh = backend or LSHMemory(LSH_NUM_BITS, LSH_VEC_DIM)
+		self.pending = {}
+		self.num_forgotten = 0
+		self.worker = ConsolidationWorker()
+		self.journal = None
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state["worker"]
+		del state["journal"]
+		return state
+
+	def __setstate__(self, state):
+		state.setdefault("pending", {})
+		state.setdefault("num_forgotten", 0)
+		self.__dict__.update(state)
+		self.worker = ConsolidationWorker()
+		self.journal = None
+
+	def begin_journal(self):
+		"""Starts recording changes to the index, so that they can be undone with rollback_journal"""
+		self.journal = []
+
+	def end_journal(self):
+		"""Stops recording changes and discards the ones recorded"""
+		self.journal = None
+
+	def rollback_journal(self):
+		"""Undoes every recorded change, newest first, then stops recording"""
+		journal, self.journal = self.journal or [], None
+		for entry in reversed(journal):
+			action, mem = entry[:2]
+			if action == "pend":
+				self.pending.pop(mem.id, None)
+			elif action == "unpend":
+				self.pending[mem.id] = mem
+			elif action == "add":
+				self.lsh.delete_memory(mem)
+			elif action == "delete":
+				# Recalled memories are reinforced after they leave the index, so restore them first
+				mem.strength, mem.last_accessed = entry[2:]
+				self.lsh.add_memory(mem)
+
+	def _record(self, action, memories):
+		if self.journal is not None:
+			self.journal.extend(
+				(action, mem, mem.strength, mem.last_accessed) if action == "delete" else (action, mem)
+				for mem in memories
+			)
+
+	def submit_memories(self, memories):
+		"""Queues memories to be embedded and indexed in the background"""
+		self._record("pend", memories)
+		for mem in memories:
+			self.pending[mem.id] = mem
+		self._submit_to_worker(memories)
+
+	def _submit_to_worker(self, memories):
+		for i in range(0, len(memories), CONSOLIDATION_BATCH_SIZE):
+			# If the queue is full, these are resubmitted once the worker is idle
+			self.worker.submit(memories[i:i+CONSOLIDATION_BATCH_SIZE])
+
+	def index_pending(self):
+		"""Indexes pending memories whose embeddings are ready.
+		Ones the worker dropped or failed to embed are resubmitted to it once it's idle."""
+		if not self.pending:
+			return
+		ready = [mem for mem in self.pending.values() if mem.embedding is not None]
+		for mem in ready:
+			del self.pending[mem.id]
+		self.lsh.add_memories(ready)
+		self._record("unpend", ready)
+		self._record("add", ready)
+		if self.pending and self.worker.is_idle():
+			self._submit_to_worker(list(self.pending.values()))
 	
-	def retrieve(self, query, k, remove=False):
-		"""Returns the top K most relevant memories"""
-		return self.lsh.retrieve(query, k, remove=remove)
+	def retrieve(self, query, k, remove=False, context=None, start=None, end=None):
+		"""Returns the top K most relevant memories, optionally limited to those created in [start, end).
+		Memories the worker hasn't embedded yet aren't searched, so recall never waits on embedding them."""
+		self.index_pending()
+		if context is None or remove:
+			memories = self.lsh.retrieve(query, k, remove=remove, context=context, start=start, end=end)
+			if remove:
+				self._record("delete", memories)
+			return memories
+		# Results stay valid until the index changes
+		key = (query, k, start, end, self.lsh.version)
+		memories = context.get_results(key)
+		if memories is None:
+			memories = self.lsh.retrieve(query, k, context=context, start=start, end=end)
+			context.set_results(key, memories)
+		return list(memories)
+
+	def retrieve_many(self, queries, k, context=None):
+		"""Returns the top K most relevant memories for each query, embedding the queries in one batch"""
+		self.index_pending()
+		context = context or RetrievalContext()
+		context.prefetch(queries)
+		keys = [(query, k, None, None, self.lsh.version) for query in queries]
+		results = [context.get_results(key) for key in keys]
+		missing = [i for i, memories in enumerate(results) if memories is None]
+		if missing:
+			found = self.lsh.retrieve_many(
+				np.stack([context.embed(queries[i]) for i in missing]),
+				k
+			)
+			for i, memories in zip(missing, found):
+				context.set_results(keys[i], memories)
+				results[i] = memories
+		return [list(memories) for memories in results]
+
+	def get_memories_between(self, start=None, end=None):
+		"""Returns the long-term memories created in [start, end), oldest first"""
+		self.index_pending()
+		memories = self.lsh.time_index.get_range(start, end)
+		if self.pending:
+			lo = start.timestamp() if start else -math.inf
+			hi = end.timestamp() if end else math.inf
+			memories.extend(
+				mem for mem in self.pending.values()
+				if lo <= mem.timestamp.timestamp() < hi
+			)
+			memories.sort(key=lambda mem: mem.timestamp)
+		return memories
 
 	def recall_random(self, remove=False):
 		"""Recalls a random subset of memories"""
-		return self.lsh.recall_random(remove=remove)
+		self.index_pending()
+		memories = self.lsh.recall_random(remove=remove)
+		if remove:
+			self._record("delete", memories)
+		return memories
 
 	def add_memory(self, memory):
 		"""Adds a new long-term memory"""
 		memory.encode()
 		self.lsh.add_memory(memory)
+		self._record("add", [memory])
 
 	def add_memories(self, memories):
 		"""Adds a list of long-term memories"""
-		if not memories:
-			return
-		memory_texts = [mem.content for mem in memories]
-		embeddings = mistral_embed_texts(memory_texts)
-		for memory, embed in zip(memories, embeddings):
-			memory.encode(embed)
-			self.lsh.add_memory(memory)
+		encode_memories(memories)
+		self.lsh.add_memories(memories)
+		self._record("add", memories)
 
 	def get_memories(self):
-		"""Returns a list of all long-term memories"""
-		return self.lsh.get_memories()
+		"""Returns a list of all long-term memories, including ones still pending"""
+		self.index_pending()
+		return self.lsh.get_memories() + list(self.pending.values())
 
 	def forget_memory(self, memory):
 		"""Removes a memory from long-term"""
-		self.lsh.delete_memory(memory)
+		if self.pending.pop(memory.id, None) is None:
+			self.lsh.delete_memory(memory)
+			self._record("delete", [memory])
+		else:
+			self._record("unpend", [memory])
 
 	def tick(self, delta):
 		"""Runs an update tick"""
@@ -371,6 +834,7 @@ class LongTermMemory:
 				print("Forgot memory because it has not been recalled in a while.")
 				print(f"Forgotten memory content: {mem.content}")
 				self.forget_memory(mem)
+				self.num_forgotten += 1
 	
 
 class MemorySystem:
@@ -379,13 +843,37 @@ class MemorySystem:
 		self.config = config
 		self.short_term = ShortTermMemory()
 		self.long_term = LongTermMemory()
-		self.last_memory = datetime.now()
+		self.last_memory = clock.now()
 		self.belief_system = BeliefSystem(config)
 		self.importance_counter = 0.0
+		self.turn_context = None
 		
 	def get_beliefs(self):
 		return self.belief_system.get_beliefs()
+
+	def get_relevant_beliefs(self):
+		"""Returns the beliefs most relevant to the current turn, within the prompt's token budget.
+		The turn's query is only used if recall already embedded it, so this never makes an API call."""
+		if not self.belief_system.heap:
+			return []
+		query_vec = None
+		context = self.turn_context
+		if context is not None and context.query is not None:
+			query_vec = context.get_embedding(context.query)
+		return self.belief_system.get_relevant_beliefs(
+			query_vec,
+			BELIEF_PROMPT_TOP_K,
+			BELIEF_PROMPT_TOKEN_BUDGET
+		)
 	
+	def begin_turn(self):
+		"""Starts a new turn, so that repeated queries can be answered from memory"""
+		self.turn_context = RetrievalContext()
+
+	def end_turn(self):
+		"""Ends the current turn and discards its cached retrieval results"""
+		self.turn_context = None
+
 	def reset_importance(self):
 		"""Resets the importance counter"""
 		self.importance_counter = 0.0
@@ -394,17 +882,38 @@ class MemorySystem:
 		"""Adds a new memory"""
 		importance = get_importance(content)
 		strength = 1 + (importance - 1) / 2
-		self.last_memory = datetime.now()
+		self.last_memory = clock.now()
 		self.short_term.add_memory(Memory(content, strength=strength, emotion=emotion))
 		self.importance_counter += importance / 10
 		#print(f"Importance: {importance}")
 		if not is_insight and importance >= 6:  # Important memories will create new beliefs
-			self.belief_system.generate_new_belief(content, importance/10)
+			self.belief_system.submit_memory(content, importance/10)
+
+	def remember_many(self, contents, is_insight=False):
+		"""Adds several new memories at once, rating their importance concurrently"""
+		if not contents:
+			return
+		importances = get_importances(contents)
+		self.last_memory = clock.now()
+		self.short_term.add_memories([
+			Memory(content, strength=1 + (importance - 1) / 2)
+			for content, importance in zip(contents, importances)
+		])
+		self.importance_counter += sum(importances) / 10
+		if not is_insight:
+			for content, importance in zip(contents, importances):
+				if importance >= 6:
+					self.belief_system.submit_memory(content, importance/10)
 
 	def recall(self, query):
 		"""Recalls and returns the most relevant memories"""
 		self.short_term.rehearse(query)
-		memories = self.long_term.retrieve(query, MEMORY_RETRIEVAL_TOP_K, remove=True)
+		memories = self.long_term.retrieve(
+			query,
+			MEMORY_RETRIEVAL_TOP_K,
+			remove=True,
+			context=self.turn_context
+		)
 		for mem in memories:
 			mem.reinforce()
 			self.short_term.add_memory(mem)
@@ -412,24 +921,27 @@ class MemorySystem:
 	
 	def tick(self, dt):
 		"""Runs an update tick"""
-		now = datetime.now()
+		now = clock.now()
 		old_memories = self.short_term.flush_old_memories()
-		for memory in old_memories:
-			self.long_term.add_memory(memory)
+		self.long_term.submit_memories(old_memories)
 		timedelta = now - self.last_memory
 		if timedelta.total_seconds() > 6 * 3600:
 			# Consolidate memories after 6 hours of inactivity
-			self.consolidate_memories()
+			self.consolidate_memories(background=True)
 			self.last_memory = now
 		
 		self.long_term.tick(dt)
 		self.belief_system.tick(dt)
 		
-	def consolidate_memories(self):
-		"""Consolidates all short-term memories into long-term"""
+	def consolidate_memories(self, background=False):
+		"""Consolidates all short-term memories into long-term.
+		If background is True, they are embedded and indexed gradually by the consolidation worker."""
 		print("Consolidating all memories...")
 		memories = self.short_term.get_memories()
-		self.long_term.add_memories(memories)
+		if background:
+			self.long_term.submit_memories(memories)
+		else:
+			self.long_term.add_memories(memories)
 		self.short_term.clear_memories()
 		
 	def surface_random_thoughts(self):
@@ -445,13 +957,37 @@ class MemorySystem:
 		memories.sort(key=lambda memory: memory.timestamp)
 		return memories
 		
-	def retrieve_long_term(self, query, top_k):
-		"""Retrieves the top K most relevant memories from long-term memory"""
-		return self.long_term.retrieve(query, top_k, remove=False)
+	def retrieve_long_term(self, query, top_k, start=None, end=None):
+		"""Retrieves the top K most relevant memories from long-term memory.
+		If start or end is given, only memories created in [start, end) are considered."""
+		return self.long_term.retrieve(
+			query,
+			top_k,
+			remove=False,
+			context=self.turn_context,
+			start=start,
+			end=end
+		)
+
+	def retrieve_long_term_many(self, queries, top_k):
+		"""Retrieves the top K most relevant long-term memories for each query, in one batch"""
+		return self.long_term.retrieve_many(queries, top_k, context=self.turn_context)
+
+	def get_memories_between(self, start=None, end=None):
+		"""Returns all short-term and long-term memories created in [start, end), oldest first"""
+		memories = (
+			self.short_term.get_memories_between(start, end)
+			+ self.long_term.get_memories_between(start, end)
+		)
+		memories.sort(key=lambda memory: memory.timestamp)
+		return memories
 	
 	def recall_memories(self, messages):
 		"""Returns the short-term and recalled long-term memories given the query"""
 		messages = [msg for msg in messages if msg["role"] != "system"]
 		context = conversation_to_string(messages[-3:])
+		turn_context = self.turn_context
+		if turn_context is not None:
+			turn_context.query = context
 		recalled_memories = self.recall(context)
 		return self.get_short_term_memories(), recalled_memories
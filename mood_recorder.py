@@ -0,0 +1,145 @@
+"""Records the AI's mood, emotions and relationship over time, for tuning and dashboards."""
+
+import io
+
+import numpy as np
+
+from const import MOOD_SAMPLE_INTERVAL, MOOD_HISTORY_SIZE, MOOD_HISTORY_DOWNSAMPLE
+
+SAMPLE_DTYPE = np.dtype([
+	("time", "f8"),
+	("pleasure", "f4"),
+	("arousal", "f4"),
+	("dominance", "f4"),
+	("emotions", "f4"),
+	("friendliness", "f4"),
+	("relation_dominance", "f4")
+])
+
+
+class SampleRing:
+	"""A fixed-size ring buffer of samples that overwrites the oldest when full"""
+
+	def __init__(self, capacity):
+		self.samples = np.zeros(capacity, dtype=SAMPLE_DTYPE)
+		self.start = 0
+		self.count = 0
+
+	def push(self, sample):
+		"""Adds a sample, and returns the one it pushed out, if any"""
+		capacity = len(self.samples)
+		index = (self.start + self.count) % capacity
+		evicted = None
+		if self.count < capacity:
+			self.count += 1
+		else:
+			evicted = self.samples[index].copy()
+			self.start = (self.start + 1) % capacity
+		self.samples[index] = sample
+		return evicted
+
+	def to_array(self):
+		"""Returns the samples from oldest to newest"""
+		return np.roll(self.samples, -self.start)[:self.count]
+
+
+class MoodRecorder:
+	"""Samples mood, active emotion count and relationship values at a fixed rate into a ring buffer.
+	Samples pushed out of it are averaged in groups into a coarser archive, so older history is kept at lower resolution."""
+
+	def __init__(
+		self,
+		sample_interval=MOOD_SAMPLE_INTERVAL,
+		capacity=MOOD_HISTORY_SIZE,
+		downsample=MOOD_HISTORY_DOWNSAMPLE
+	):
+		self.sample_interval = sample_interval
+		self.recent = SampleRing(capacity)
+		self.archive = SampleRing(capacity)
+		self.carry = np.zeros(downsample, dtype=SAMPLE_DTYPE)
+		self.num_carry = 0
+		self.last_sample = None
+		self.version = 0
+
+	def maybe_record(self, now, emotion_system):
+		"""Takes a sample if at least the sample interval has passed since the last one"""
+		if self.last_sample is not None and now - self.last_sample < self.sample_interval:
+			return False
+		mood = emotion_system.mood
+		relation = emotion_system.relation
+		self.record((
+			now,
+			mood.pleasure,
+			mood.arousal,
+			mood.dominance,
+			emotion_system.num_emotions,
+			relation.friendliness,
+			relation.dominance
+		))
+		return True
+
+	def record(self, sample):
+		"""Records a sample, given as a tuple in the order of SAMPLE_DTYPE's fields"""
+		self.last_sample = sample[0]
+		self.version += 1
+		evicted = self.recent.push(sample)
+		if evicted is None:
+			return
+		self.carry[self.num_carry] = evicted
+		self.num_carry += 1
+		if self.num_carry == len(self.carry):
+			self.archive.push(tuple(self.carry[name].mean() for name in SAMPLE_DTYPE.names))
+			self.num_carry = 0
+
+	def get_history(self):
+		"""Returns every recorded sample from oldest to newest, with the downsampled ones first"""
+		return np.concatenate([
+			self.archive.to_array(),
+			self.carry[:self.num_carry],
+			self.recent.to_array()
+		])
+
+	def export_csv(self, path):
+		"""Writes the history to a CSV file with a header row"""
+		np.savetxt(
+			path,
+			self.get_history(),
+			delimiter=",",
+			header=",".join(SAMPLE_DTYPE.names),
+			comments="",
+			fmt=["%.3f"] + ["%.5g"] * (len(SAMPLE_DTYPE.names) - 1)
+		)
+
+	def export_binary(self, path):
+		"""Writes the history as a NumPy .npy file of records"""
+		np.save(path, self.get_history(), allow_pickle=False)
+
+	def to_bytes(self):
+		"""Serializes the whole recorder state, including the sample interval"""
+		buffer = io.BytesIO()
+		np.savez(
+			buffer,
+			recent=self.recent.to_array(),
+			archive=self.archive.to_array(),
+			carry=self.carry[:self.num_carry],
+			sizes=np.array([len(self.recent.samples), len(self.carry)]),
+			sample_interval=np.array(self.sample_interval)
+		)
+		return buffer.getvalue()
+
+	@classmethod
+	def from_bytes(cls, data):
+		"""Restores a recorder serialized with to_bytes"""
+		arrays = np.load(io.BytesIO(data), allow_pickle=False)
+		capacity, downsample = arrays["sizes"].tolist()
+		recorder = cls(float(arrays["sample_interval"]), capacity, downsample)
+		for sample in arrays["archive"]:
+			recorder.archive.push(sample)
+		carry = arrays["carry"]
+		recorder.carry[:len(carry)] = carry
+		recorder.num_carry = len(carry)
+		for sample in arrays["recent"]:
+			recorder.recent.push(sample)
+		if recorder.recent.count:
+			recorder.last_sample = float(recorder.recent.to_array()["time"][-1])
+		return recorder
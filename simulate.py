@@ -0,0 +1,323 @@
+"""Simulates long-term use of the AI system in virtual time, against a local stand-in for the LLM API."""
+
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import argparse
+import tempfile
+import threading
+import contextlib
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import clock
+import llm
+from const import LSH_VEC_DIM
+
+TOPICS = {
+	"music": "band concert guitar song album lyrics drums melody",
+	"work": "boss deadline project meeting office promotion coworker email",
+	"family": "mother father sister brother dinner holiday visit birthday",
+	"games": "level quest puzzle strategy score controller online team",
+	"travel": "beach mountain train flight hotel museum city map",
+	"health": "sleep doctor exercise running tired diet headache gym",
+	"books": "novel author chapter library poetry story character ending"
+}
+
+REACTIONS = ["ok", "lol", "haha nice", "thanks!", "hmm", "cool 👍", "ugh", "i see", "yeah", "wow"]
+
+
+class StubBackend:
+	"""A deterministic stand-in for the Mistral AI API.
+	Chat completions are filled in from the requested JSON schema, using words from the last message.
+	Embeddings are bags of seeded random word vectors, so texts that share words are similar.
+	Each call can be delayed to stand in for network latency, and a fraction of thought outputs can come back empty."""
+
+	def __init__(self, seed=0, embed_size=LSH_VEC_DIM, latency=0.0, empty_rate=0.0):
+		self.rng = random.Random(seed)
+		self.embed_size = embed_size
+		self.latency = latency
+		self.empty_rate = empty_rate
+		self.word_vectors = {}
+		self.calls = {"chat": 0, "embed": 0}
+		self.lock = threading.Lock()
+
+	def _word_vector(self, word):
+		vec = self.word_vectors.get(word)
+		if vec is None:
+			rng = np.random.default_rng(zlib.crc32(word.encode()))
+			vec = self.word_vectors[word] = rng.normal(size=self.embed_size)
+		return vec
+
+	def _embed(self, text):
+		words = re.findall(r"[a-z']+", text.lower()) or [""]
+		vec = sum(self._word_vector(word) for word in words)
+		return (vec / np.linalg.norm(vec)).tolist()
+
+	def embed(self, data):
+		"""Returns an embeddings response for the request"""
+		inputs = data["input"]
+		if isinstance(inputs, str):
+			inputs = [inputs]
+		if self.latency:
+			time.sleep(self.latency)
+		with self.lock:
+			self.calls["embed"] += 1
+			return {"data": [{"embedding": self._embed(text)} for text in inputs]}
+
+	def _sentence(self, words):
+		return " ".join(self.rng.choice(words) for _ in range(self.rng.randint(4, 10))).capitalize() + "."
+
+	def _fill(self, schema, root, words):
+		if "$ref" in schema:
+			return self._fill(root["$defs"][schema["$ref"].split("/")[-1]], root, words)
+		if "anyOf" in schema:
+			return self._fill(self.rng.choice(schema["anyOf"]), root, words)
+		if "enum" in schema:
+			return self.rng.choice(schema["enum"])
+		schema_type = schema.get("type")
+		if schema_type == "object":
+			return {
+				key: self._fill(value, root, words)
+				for key, value in schema.get("properties", {}).items()
+			}
+		if schema_type == "array":
+			num_items = schema.get("minLength", self.rng.randint(1, 3))
+			return [self._fill(schema["items"], root, words) for _ in range(num_items)]
+		if schema_type == "string":
+			return self._sentence(words)
+		if schema_type == "integer":
+			return self.rng.randint(-100, 100)
+		if schema_type == "number":
+			return self.rng.uniform(-1, 1)
+		if schema_type == "boolean":
+			return self.rng.random() < 0.5
+		return None
+
+	def _complete(self, data, words):
+		response_format = data.get("response_format", {})
+		format_type = response_format.get("type")
+		if format_type == "json_schema":
+			schema = response_format["json_schema"]["schema"]
+			result = self._fill(schema, schema, words)
+			if "thoughts" in result and self.rng.random() < self.empty_rate:
+				result["thoughts"] = []
+			return json.dumps(result)
+		if format_type == "json_object":
+			return json.dumps({
+				"questions": [self._sentence(words) for _ in range(3)],
+				"insights": [self._sentence(words) for _ in range(2)]
+			})
+		if data["model"] == "open-mistral-nemo":  # Only used to rate importance
+			return str(self.rng.randint(1, 10))
+		return self._sentence(words)
+
+	def chat(self, data):
+		"""Returns a chat completion response for the request"""
+		content = data["messages"][-1]["content"]
+		if isinstance(content, list):
+			content = " ".join(part.get("text", "") for part in content)
+		words = re.findall(r"[a-z']+", content.lower())[-40:] or ["hello"]
+		if self.latency:
+			time.sleep(self.latency)
+		with self.lock:
+			self.calls["chat"] += 1
+			return {
+				"choices": [
+					{"message": {"role": "assistant", "content": self._complete(data, words)}}
+					for _ in range(data.get("n") or 1)
+				]
+			}
+
+
+def load_script(path):
+	"""Loads scripted user messages, one per line"""
+	with open(path, "r", encoding="utf-8") as file:
+		return [line.strip() for line in file if line.strip()]
+
+
+def make_message(rng, reaction_rate=0.0):
+	"""Generates a user message about a random topic, or sometimes a short reaction"""
+	if rng.random() < reaction_rate:
+		return rng.choice(REACTIONS)
+	topic = rng.choice(list(TOPICS))
+	words = rng.sample(TOPICS[topic].split(), 4)
+	return f"I want to talk about {topic}. Lately it's been all about the {', '.join(words)}."
+
+
+def _count_memories(ai):
+	long_term = ai.memory_system.long_term
+	# Memories the worker has embedded are only indexed when long-term memory is next used
+	long_term.index_pending()
+	return {
+		"short_term": len(ai.memory_system.short_term.memories),
+		"long_term": long_term.lsh.count,
+		"pending": len(long_term.pending)
+	}
+
+
+def simulate(
+	days,
+	messages_per_day,
+	seed=0,
+	report_every=30,
+	script=None,
+	log=None,
+	latency=0.0,
+	empty_rate=0.0,
+	retry_strategy="sample",
+	reaction_rate=0.2
+):
+	"""Runs the AI system through the given number of virtual days, returning one report row per period"""
+	from main import AISystem  # pylint: disable=C0415
+	from memory_system import ConsolidationWorker  # pylint: disable=C0415
+
+	rng = random.Random(seed)
+	sim_clock = clock.SimulatedClock(datetime(2025, 1, 1, 7, 0))
+	previous_clock = clock.set_clock(sim_clock)
+	backend = StubBackend(seed, latency=latency, empty_rate=empty_rate)
+	previous_backend = llm.set_backend(backend)
+	# The worker paces itself in real time, which would leave it far behind the virtual clock
+	previous_delay = ConsolidationWorker.trickle_delay
+	ConsolidationWorker.trickle_delay = 0.0
+	script_pos = 0
+	rows = []
+	try:
+		ai = AISystem()
+		ai.set_thought_visibility(False)
+		ai.thought_system.retry_strategy = retry_strategy
+		ai.on_startup()
+		tick_times = []
+		turn_times = []
+		last_forgotten = 0
+		for day in range(days):
+			day_start = datetime(2025, 1, 1, 7, 0) + timedelta(days=day)
+			sim_clock.current = max(sim_clock.current, day_start + timedelta(hours=rng.uniform(1, 14)))
+			for _ in range(messages_per_day):
+				sim_clock.advance(rng.uniform(20, 600))
+				if script:
+					message = script[script_pos % len(script)]
+					script_pos += 1
+				else:
+					message = make_message(rng, reaction_rate)
+				start = time.perf_counter()
+				ai.tick()
+				tick_times.append(time.perf_counter() - start)
+				start = time.perf_counter()
+				ai.send_message(message)
+				ai.wait_for_background_work()
+				turn_times.append(time.perf_counter() - start)
+			ai.flush()
+
+			# An idle tick overnight, which is when most forgetting happens
+			sim_clock.current = max(sim_clock.current, day_start + timedelta(days=1))
+			start = time.perf_counter()
+			ai.tick()
+			tick_times.append(time.perf_counter() - start)
+			ai.memory_system.long_term.worker.queue.join()
+
+			if (day + 1) % report_every == 0 or day == days - 1:
+				forgotten = ai.memory_system.long_term.num_forgotten
+				row = {
+					"day": day + 1,
+					**_count_memories(ai),
+					"beliefs": len(ai.get_beliefs()),
+					"forgotten": forgotten - last_forgotten,
+					"forgotten_total": forgotten,
+					"tick_ms_mean": 1000 * float(np.mean(tick_times)),
+					"tick_ms_max": 1000 * float(np.max(tick_times)),
+					"turn_ms_mean": 1000 * float(np.mean(turn_times)),
+					"thought_generation": ai.thought_system.generation_stats.get_summary(),
+					"appraisal": ai.emotion_system.appraisal_stats.get_summary(),
+					"api_calls": dict(backend.calls)
+				}
+				rows.append(row)
+				if log:
+					log(row)
+				last_forgotten = forgotten
+				tick_times = []
+				turn_times = []
+	finally:
+		clock.set_clock(previous_clock)
+		llm.set_backend(previous_backend)
+		ConsolidationWorker.trickle_delay = previous_delay
+	return rows
+
+
+def _print_row(row):
+	print(
+		f"day {row['day']:4d}: {row['short_term']:3d} short-term, {row['long_term']:6d} long-term, "
+		f"{row['pending']:3d} pending, {row['beliefs']:3d} beliefs, {row['forgotten']:5d} forgotten "
+		f"({row['forgotten_total']} total), tick {row['tick_ms_mean']:.2f} ms "
+		f"(max {row['tick_ms_max']:.2f}), turn {row['turn_ms_mean']:.1f} ms",
+		file=sys.__stdout__,
+		flush=True
+	)
+	stats = row["appraisal"]
+	if stats:
+		agreement = "n/a" if stats["agreement"] is None else f"{stats['agreement']:.0%}"
+		print(
+			f"          appraisal: {stats['escalation_rate']:.1%} escalated, "
+			f"{agreement} agreement over {stats['compared']} compared",
+			file=sys.__stdout__,
+			flush=True
+		)
+	stats = row["thought_generation"]
+	if stats:
+		print(
+			f"          thoughts: {stats['success_rate']:.1%} success, {stats['calls_per_attempt']:.2f} calls, "
+			f"{stats['latency_mean']*1000:.1f} ms mean, {stats['latency_p95']*1000:.1f} ms p95",
+			file=sys.__stdout__,
+			flush=True
+		)
+
+
+def main():
+	"""Runs the simulation"""
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument("--days", type=int, default=365)
+	parser.add_argument("--messages-per-day", type=int, default=4)
+	parser.add_argument("--report-every", type=int, default=30, help="days per report row")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--script", help="a file of user messages, one per line, replayed in order")
+	parser.add_argument("--output", help="also write the report rows here as JSON")
+	parser.add_argument("--latency", type=float, default=0.0, help="seconds each API call takes")
+	parser.add_argument("--empty-rate", type=float, default=0.0, help="fraction of thought outputs that come back empty")
+	parser.add_argument("--retry-strategy", choices=["sample", "sequential"], default="sample")
+	parser.add_argument("--reaction-rate", type=float, default=0.2, help="fraction of messages that are short reactions")
+	args = parser.parse_args()
+
+	script = load_script(args.script) if args.script else None
+	output = os.path.abspath(args.output) if args.output else None
+	# Anything the AI system writes to the working directory, like the summary cache, stays out of the real one
+	cwd = os.getcwd()
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		os.chdir(tmp_dir)
+		try:
+			with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+				rows = simulate(
+					args.days,
+					args.messages_per_day,
+					seed=args.seed,
+					report_every=args.report_every,
+					script=script,
+					log=_print_row,
+					latency=args.latency,
+					empty_rate=args.empty_rate,
+					retry_strategy=args.retry_strategy,
+					reaction_rate=args.reaction_rate
+				)
+		finally:
+			os.chdir(cwd)
+	if output:
+		with open(output, "w", encoding="utf-8") as file:
+			json.dump(rows, file, indent=2)
+
+
+if __name__ == "__main__":
+	main()
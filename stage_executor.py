@@ -0,0 +1,169 @@
+"""Runs the stages of a turn as a dependency graph on a shared thread pool, timing each stage."""
+
+import io
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from const import STAGE_WORKERS
+
+_executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix="stage")
+_local = threading.local()
+
+
+class _ThreadStdout:
+	"""Stands in for stdout, sending what a capturing thread prints to its buffer and the rest to the real stdout"""
+
+	def __init__(self, stream):
+		self.stream = stream
+
+	def write(self, text):
+		buffer = getattr(_local, "buffer", None)
+		return (buffer or self.stream).write(text)
+
+	def __getattr__(self, name):
+		return getattr(self.stream, name)
+
+
+def _run_capturing_output(stage, kwargs):
+	# Keeps what the stage prints in stage.output, without holding back what other threads print
+	if not isinstance(sys.stdout, _ThreadStdout):
+		sys.stdout = _ThreadStdout(sys.stdout)
+	_local.buffer = io.StringIO()
+	try:
+		return stage.func(**kwargs)
+	finally:
+		stage.output = _local.buffer.getvalue()
+		_local.buffer = None
+
+
+class Stage:
+	"""A unit of work in a StageGraph"""
+
+	def __init__(self, name, func, deps, capture_output=False):
+		self.name = name
+		self.func = func
+		self.deps = tuple(deps)
+		self.capture_output = capture_output
+		self.output = ""
+		self.future = Future()
+		self.start = None
+		self.end = None
+
+
+class StageGraph:
+	"""A set of stages that each run as soon as the stages they depend on have finished.
+	Each stage's function is called with the results of its dependencies as keyword arguments."""
+
+	def __init__(self):
+		self.stages = {}
+		self.lock = threading.Lock()
+		self.started = None
+
+	def add(self, name, func, deps=(), capture_output=False):
+		"""Adds a stage. Its dependencies must already have been added.
+		If capture_output is True, what the stage prints is kept for get_output instead of being printed."""
+		for dep in deps:
+			if dep not in self.stages:
+				raise ValueError(f"Stage '{name}' depends on unknown stage '{dep}'")
+		self.stages[name] = Stage(name, func, deps, capture_output)
+
+	def start(self):
+		"""Starts running the stages in the background"""
+		self.started = time.perf_counter()
+		for stage in self.stages.values():
+			if not stage.deps:
+				stage.future.set_running_or_notify_cancel()
+				_executor.submit(self._run_stage, stage)
+
+	def _run_stage(self, stage):
+		try:
+			kwargs = {dep: self.stages[dep].future.result() for dep in stage.deps}
+			stage.start = time.perf_counter()
+			if stage.capture_output:
+				result = _run_capturing_output(stage, kwargs)
+			else:
+				result = stage.func(**kwargs)
+		except Exception as e:  # pylint: disable=W0718
+			stage.end = time.perf_counter()
+			stage.future.set_exception(e)
+		else:
+			stage.end = time.perf_counter()
+			stage.future.set_result(result)
+		self._submit_ready(stage)
+
+	def _submit_ready(self, finished):
+		# Submits the stages that were only waiting on the finished stage
+		with self.lock:
+			for stage in self.stages.values():
+				if (
+					finished.name in stage.deps
+					and not stage.future.running()
+					and not stage.future.done()
+					and all(self.stages[dep].future.done() for dep in stage.deps)
+				):
+					stage.future.set_running_or_notify_cancel()
+					_executor.submit(self._run_stage, stage)
+
+	def result(self, name, timeout=None):
+		"""Waits for a stage and returns its result, raising its exception if it failed"""
+		return self.stages[name].future.result(timeout)
+
+	def exception(self, name, timeout=None):
+		"""Waits for a stage and returns the exception it raised, or None if it succeeded"""
+		return self.stages[name].future.exception(timeout)
+
+	def get_output(self):
+		"""Returns what the stages that capture their output printed, in the order they were added"""
+		return "".join(stage.output for stage in self.stages.values())
+
+	def wait(self, timeout=None):
+		"""Waits for every stage, raising the first exception any of them raised"""
+		for stage in self.stages.values():
+			stage.future.result(timeout)
+
+	def run(self, name):
+		"""Starts the stages and waits for the result of one of them.
+		Stages that don't lead to it keep running in the background."""
+		self.start()
+		return self.result(name)
+
+	def get_critical_path(self, name):
+		"""Returns the chain of stages that determined when the stage finished, from first to last"""
+		path = []
+		stage = self.stages[name]
+		while stage is not None:
+			path.append(stage)
+			deps = [self.stages[dep] for dep in stage.deps if self.stages[dep].end is not None]
+			stage = max(deps, key=lambda s: s.end, default=None)
+		return path[::-1]
+
+	def get_report(self, name):
+		"""Returns the timings of the stages and the critical path to the stage, in seconds"""
+		path = self.get_critical_path(name)
+		target = self.stages[name]
+		timings = {
+			stage.name: stage.end - stage.start
+			for stage in self.stages.values()
+			if stage.start is not None and stage.end is not None
+		}
+		return {
+			"latency": target.end - self.started if target.end is not None else None,
+			"critical_path": [(stage.name, timings.get(stage.name, 0.0)) for stage in path],
+			"stages": timings
+		}
+
+	def format_report(self, name):
+		"""Formats the report of the stage as a human-readable string"""
+		report = self.get_report(name)
+		lines = []
+		if report["latency"] is not None:
+			lines.append(f"Latency: {report['latency']*1000:.0f} ms")
+		lines.append("Critical path: " + " -> ".join(
+			f"{stage} ({duration*1000:.0f} ms)" for stage, duration in report["critical_path"]
+		))
+		lines.append("Stages:")
+		for stage, duration in report["stages"].items():
+			lines.append(f"- {stage}: {duration*1000:.0f} ms")
+		return "\n".join(lines)
@@ -0,0 +1,378 @@
+"""Durable, incremental storage for the AI system, backed by SQLite."""
+
+import json
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+
+from memory_system import Memory
+from emotion_system import Emotion
+from mood_recorder import MoodRecorder
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS memories (
+	id TEXT PRIMARY KEY,
+	tier TEXT NOT NULL,
+	position INTEGER NOT NULL,
+	content TEXT NOT NULL,
+	timestamp REAL NOT NULL,
+	last_accessed REAL NOT NULL,
+	strength REAL NOT NULL,
+	pleasure REAL NOT NULL,
+	arousal REAL NOT NULL,
+	dominance REAL NOT NULL,
+	embedding BLOB
+);
+CREATE TABLE IF NOT EXISTS beliefs (
+	position INTEGER PRIMARY KEY,
+	content TEXT NOT NULL,
+	importance REAL NOT NULL,
+	embedding BLOB,
+	source_embedding BLOB,
+	potential REAL
+);
+CREATE TABLE IF NOT EXISTS state (
+	key TEXT PRIMARY KEY,
+	value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS recordings (
+	key TEXT PRIMARY KEY,
+	data BLOB NOT NULL
+);
+"""
+
+# Columns added after a table was first created, as (table, column, type)
+MIGRATIONS = [
+	("beliefs", "embedding", "BLOB"),
+	("beliefs", "source_embedding", "BLOB"),
+	("beliefs", "potential", "REAL")
+]
+
+
+def _to_blob(vec):
+	return None if vec is None else np.asarray(vec, dtype=np.float64).tobytes()
+
+
+def _from_blob(blob):
+	return None if blob is None else np.frombuffer(blob, dtype=np.float64).copy()
+
+
+def _to_iso(dt):
+	return dt.isoformat() if dt else None
+
+
+def _from_iso(string):
+	return datetime.fromisoformat(string) if string else None
+
+
+def _memory_row(memory, tier, position):
+	emotion = memory.emotion
+	return (
+		memory.id,
+		tier,
+		position,
+		memory.content,
+		memory.timestamp.timestamp(),
+		memory.last_accessed.timestamp(),
+		memory.strength,
+		emotion.pleasure,
+		emotion.arousal,
+		emotion.dominance,
+		_to_blob(memory.embedding)
+	)
+
+
+def _memory_from_row(row):
+	(
+		memory_id, _, _, content, timestamp, last_accessed,
+		strength, pleasure, arousal, dominance, embedding
+	) = row
+	memory = Memory(content, strength=strength, emotion=Emotion(pleasure, arousal, dominance))
+	memory.id = memory_id
+	memory.timestamp = datetime.fromtimestamp(timestamp)
+	memory.last_accessed = datetime.fromtimestamp(last_accessed)
+	memory.embedding = _from_blob(embedding)
+	return memory
+
+
+def _fingerprint(memory, tier, position):
+	# The fields of a memory that can change after it has been written
+	return (
+		tier,
+		position,
+		memory.last_accessed.timestamp(),
+		memory.strength,
+		memory.embedding is not None
+	)
+
+
+class SQLiteStore:
+	"""Saves the AI system to a SQLite database, writing only what changed since the last save"""
+
+	def __init__(self, path):
+		self.path = path
+		self.conn = sqlite3.connect(path)
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		self.conn.execute("PRAGMA synchronous=NORMAL")
+		self.conn.executescript(SCHEMA)
+		self._migrate()
+		self._reset_cache()
+
+	def _migrate(self):
+		for table, column, column_type in MIGRATIONS:
+			columns = [row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")]
+			if column not in columns:
+				self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+		self.conn.commit()
+
+	def _reset_cache(self):
+		# Mirrors what is currently in the database, so saves can be diffed against it
+		self.written_rows = {}
+		self.written_long_ids = set()
+		self.written_beliefs = None
+		self.written_state = {}
+		self.written_recording = None
+
+	def close(self):
+		"""Closes the database connection"""
+		self.conn.close()
+
+	def clear(self):
+		"""Erases everything in the database"""
+		with self.conn:
+			self.conn.execute("DELETE FROM memories")
+			self.conn.execute("DELETE FROM beliefs")
+			self.conn.execute("DELETE FROM state")
+			self.conn.execute("DELETE FROM recordings")
+		self._reset_cache()
+
+	def get_state(self, key):
+		"""Returns the decoded value of a state entry, or None if it doesn't exist"""
+		row = self.conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+		return json.loads(row[0]) if row else None
+
+	def _get_state_entries(self, ai):
+		memory_system = ai.memory_system
+		emotion_system = ai.emotion_system
+		thought_system = ai.thought_system
+		return {
+			"config": ai.config.dict(),
+			"ai": {
+				"num_messages": ai.num_messages,
+				"last_message": _to_iso(ai.last_message),
+				"last_recall_tick": _to_iso(ai.last_recall_tick),
+				"last_tick": _to_iso(ai.last_tick),
+				"messages": list(ai.buffer.messages),
+				"unremembered": [
+					{
+						**turn_input,
+						"emotion": turn_input["emotion"] and [
+							turn_input["emotion"].pleasure,
+							turn_input["emotion"].arousal,
+							turn_input["emotion"].dominance
+						]
+					}
+					for turn_input in ai.unremembered
+				]
+			},
+			"memory": {
+				"last_memory": _to_iso(memory_system.last_memory),
+				"importance_counter": memory_system.importance_counter
+			},
+			"thought": {
+				"last_reflection": _to_iso(thought_system.last_reflection),
+				"reflection_counter": thought_system.reflection_counter,
+				"show_thoughts": thought_system.show_thoughts
+			},
+			"emotion": {
+				"mood": [emotion_system.mood.pleasure, emotion_system.mood.arousal, emotion_system.mood.dominance],
+				"emotions": [[em.pleasure, em.arousal, em.dominance] for em in emotion_system.emotions],
+				"last_update": emotion_system.last_update
+			},
+			"relation": {
+				"friendliness": ai.relation_system.friendliness,
+				"dominance": ai.relation_system.dominance
+			},
+			"personality_summary": ai.personality_system.summary,
+			"beliefs": {"elapsed": memory_system.belief_system.elapsed},
+			"belief_queue": list(memory_system.belief_system.get_pending().items())
+		}
+
+	def _save_memories(self, memory_system):
+		long_term = memory_system.long_term
+		current = {}
+		memories = {}
+		for i, memory in enumerate(memory_system.short_term.memories):
+			current[memory.id] = _fingerprint(memory, "short", i)
+			memories[memory.id] = memory
+		for memory in long_term.pending.values():
+			current[memory.id] = _fingerprint(memory, "pending", 0)
+			memories[memory.id] = memory
+
+		# Memories don't change while they're in the LSH index, so only membership needs diffing
+		lsh_ids = long_term.lsh.memory_ids
+		long_ids = set(lsh_ids)
+		stored_ids = self.written_long_ids | set(self.written_rows)
+		inserts = []
+		updates = []
+		for memory_id in long_ids - self.written_long_ids:
+			memory = lsh_ids[memory_id][0]
+			if memory_id in self.written_rows and self.written_rows[memory_id][4]:
+				updates.append(("long", 0, memory.last_accessed.timestamp(), memory.strength, memory_id))
+			else:
+				inserts.append(_memory_row(memory, "long", 0))
+
+		for memory_id, fingerprint in current.items():
+			old = self.written_rows.get(memory_id)
+			if old == fingerprint:
+				continue
+			has_embedding = fingerprint[4]
+			was_long = memory_id in self.written_long_ids
+			if (old is not None and old[4] == has_embedding) or (was_long and has_embedding):
+				updates.append((*fingerprint[:4], memory_id))
+			else:
+				tier, position = fingerprint[:2]
+				inserts.append(_memory_row(memories[memory_id], tier, position))
+
+		deleted = stored_ids - long_ids - current.keys()
+		if inserts:
+			self.conn.executemany(
+				"INSERT OR REPLACE INTO memories VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+				inserts
+			)
+		if updates:
+			self.conn.executemany(
+				"UPDATE memories SET tier = ?, position = ?, last_accessed = ?, strength = ? WHERE id = ?",
+				updates
+			)
+		if deleted:
+			self.conn.executemany("DELETE FROM memories WHERE id = ?", [(i,) for i in deleted])
+
+		self.written_rows = current
+		self.written_long_ids = long_ids
+
+	def _save_beliefs(self, belief_system):
+		# Potentials don't change as beliefs decay, so only new or merged beliefs cause a write
+		ranked = belief_system.get_ranked_beliefs()
+		beliefs = [(i, b["content"], b["potential"]) for i, b in enumerate(ranked)]
+		if beliefs == self.written_beliefs:
+			return
+		self.conn.execute("DELETE FROM beliefs")
+		self.conn.executemany(
+			"INSERT INTO beliefs VALUES (?, ?, ?, ?, ?, ?)",
+			[
+				(
+					i,
+					b["content"],
+					belief_system.get_importance(b),  # As of this write
+					_to_blob(b.get("embedding")),
+					_to_blob(b.get("source_embedding")),
+					b["potential"]
+				)
+				for i, b in enumerate(ranked)
+			]
+		)
+		self.written_beliefs = beliefs
+
+	def _save_state(self, ai):
+		for key, value in self._get_state_entries(ai).items():
+			value = json.dumps(value)
+			if self.written_state.get(key) == value:
+				continue
+			self.conn.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (key, value))
+			self.written_state[key] = value
+
+	def _save_recording(self, recorder):
+		version = (id(recorder), recorder.version)
+		if version == self.written_recording:
+			return
+		self.conn.execute("INSERT OR REPLACE INTO recordings VALUES (?, ?)", ("mood", recorder.to_bytes()))
+		self.written_recording = version
+
+	def save(self, ai):
+		"""Writes the changes to the AI system since the last save in a single transaction"""
+		ai.wait_for_background_work()
+		with self.conn:
+			self._save_memories(ai.memory_system)
+			self._save_beliefs(ai.memory_system.belief_system)
+			self._save_state(ai)
+			self._save_recording(ai.emotion_system.recorder)
+
+	def restore(self, ai):
+		"""Restores the saved state into a newly created AI system"""
+		state = {
+			key: json.loads(value)
+			for key, value in self.conn.execute("SELECT key, value FROM state")
+		}
+		self.written_state = {key: json.dumps(value) for key, value in state.items()}
+
+		ai_state = state["ai"]
+		ai.num_messages = ai_state["num_messages"]
+		ai.last_message = _from_iso(ai_state["last_message"])
+		ai.last_recall_tick = _from_iso(ai_state["last_recall_tick"])
+		ai.last_tick = _from_iso(ai_state["last_tick"])
+		ai.buffer.messages.extend(ai_state["messages"])
+		ai.unremembered = [
+			{**turn_input, "emotion": turn_input["emotion"] and Emotion(*turn_input["emotion"])}
+			for turn_input in ai_state.get("unremembered", [])
+		]
+
+		memory_system = ai.memory_system
+		memory_system.last_memory = _from_iso(state["memory"]["last_memory"])
+		memory_system.importance_counter = state["memory"]["importance_counter"]
+
+		thought_state = state["thought"]
+		ai.thought_system.last_reflection = _from_iso(thought_state["last_reflection"])
+		ai.thought_system.reflection_counter = thought_state["reflection_counter"]
+		ai.thought_system.show_thoughts = thought_state["show_thoughts"]
+
+		emotion_state = state["emotion"]
+		ai.emotion_system.mood = Emotion(*emotion_state["mood"])
+		ai.emotion_system.emotions = [Emotion(*em) for em in emotion_state["emotions"]]
+		ai.emotion_system.last_update = emotion_state["last_update"]
+		row = self.conn.execute("SELECT data FROM recordings WHERE key = 'mood'").fetchone()
+		if row:
+			recorder = MoodRecorder.from_bytes(row[0])
+			recorder.sample_interval = ai.config.mood_sample_interval
+			ai.emotion_system.recorder = recorder
+			self.written_recording = (id(recorder), recorder.version)
+		ai.relation_system.set_relation(**state["relation"])
+		ai.personality_system.summary = state["personality_summary"]
+
+		short_term = []
+		indexed = []
+		long_term = memory_system.long_term
+		self.written_rows = {}
+		self.written_long_ids = set()
+		for row in self.conn.execute("SELECT * FROM memories ORDER BY position"):
+			memory = _memory_from_row(row)
+			tier = row[1]
+			if tier == "short":
+				short_term.append(memory)
+				self.written_rows[memory.id] = _fingerprint(memory, tier, row[2])
+			elif tier == "pending":
+				long_term.pending[memory.id] = memory
+				self.written_rows[memory.id] = _fingerprint(memory, tier, 0)
+			else:
+				indexed.append(memory)
+				self.written_long_ids.add(memory.id)
+		long_term.lsh.add_memories(indexed)
+		memory_system.short_term.add_memories(short_term)
+
+		belief_system = memory_system.belief_system
+		belief_system.elapsed = state.get("beliefs", {}).get("elapsed", 0.0)
+		rows = self.conn.execute("SELECT * FROM beliefs ORDER BY position").fetchall()
+		belief_system.set_beliefs([
+			{
+				"content": content,
+				"importance": importance,
+				"embedding": _from_blob(embedding),
+				"source_embedding": _from_blob(source_embedding),
+				"potential": potential
+			}
+			for _, content, importance, embedding, source_embedding, potential in rows
+		])
+		self.written_beliefs = [(i, content, potential) for i, content, _, _, _, potential in rows]
+		for memory, importance in state.get("belief_queue", []):
+			belief_system.submit_memory(memory, importance)
@@ -2,17 +2,48 @@
 #pylint:disable=C0114
 import json
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from llm import MistralLLM
+import clock
 from const import *
-from utils import (
-	format_memories_to_string,
-	time_since_last_message_string
-)
 from emotion_system import Emotion
 from colored import Fore, Style
 
+_reflection_executor = ThreadPoolExecutor(max_workers=REFLECTION_CONCURRENCY, thread_name_prefix="reflection")
+
+
+class GenerationStats:
+	"""Tracks how often generating thoughts succeeds, and how long and how many calls it takes"""
+
+	def __init__(self):
+		self.attempts = 0
+		self.successes = 0
+		self.calls = 0
+		self.latencies = []
+
+	def record(self, success, calls, latency):
+		"""Records the outcome of generating one thought output"""
+		self.attempts += 1
+		self.successes += int(success)
+		self.calls += calls
+		self.latencies.append(latency)
+		del self.latencies[:-1000]
+
+	def get_summary(self):
+		"""Returns the success rate, mean calls per attempt and latency statistics in seconds"""
+		if not self.attempts:
+			return None
+		latencies = sorted(self.latencies)
+		return {
+			"attempts": self.attempts,
+			"success_rate": self.successes / self.attempts,
+			"calls_per_attempt": self.calls / self.attempts,
+			"latency_mean": sum(latencies) / len(latencies),
+			"latency_p95": latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+			"latency_max": latencies[-1]
+		}
+
 
 class ThoughtSystem:
 
@@ -32,13 +63,71 @@ class ThoughtSystem:
 		self.personality_system = personality_system
 		self.show_thoughts = True
 		self.reflection_counter = 0
-		self.last_reflection = datetime.now()
+		self.last_reflection = clock.now()
+		self.step_latency = None  # Moving average of how long a thinking step takes, in seconds
+		self.last_thinking = None
+		# "sample" asks for several candidates in one call if the first output is empty; "sequential" retries one at a time
+		self.retry_strategy = "sample"
+		self.generation_stats = GenerationStats()
+
+	def __setstate__(self, state):
+		state.setdefault("step_latency", None)
+		state.setdefault("last_thinking", None)
+		state.setdefault("retry_strategy", "sample")
+		state.setdefault("generation_stats", GenerationStats())
+		self.__dict__.update(state)
+
+	def _generate_thoughts(self, thought_history, schema=THOUGHT_SCHEMA, required=("thoughts",)):
+		# Generates the first thought output, retrying if any of the required fields comes back empty
+		start = time.perf_counter()
+		def generate(n=None):
+			return self.model.generate(
+				thought_history,
+				temperature=1.0,
+				return_json=True,
+				schema=schema,
+				n=n
+			)
+
+		def is_complete(data):
+			return all(data.get(key) for key in required)
+
+		data = generate()
+		calls = 1
+		if not is_complete(data):
+			if self.retry_strategy == "sequential":
+				while calls < THOUGHT_MAX_RETRIES and not is_complete(data):
+					data = generate()
+					calls += 1
+			else:
+				calls += 1
+				candidates = generate(THOUGHT_RETRY_SAMPLES)
+				data = next((c for c in candidates if is_complete(c)), candidates[0])
+		self.generation_stats.record(is_complete(data), calls, time.perf_counter() - start)
+		return data
+
+	def _record_step_latency(self, seconds):
+		if self.step_latency is None:
+			self.step_latency = seconds
+		else:
+			alpha = THINKING_LATENCY_SMOOTHING
+			self.step_latency = alpha * seconds + (1 - alpha) * self.step_latency
+
+	def _get_stop_reason(self, num_steps, deadline, thinking_tokens):
+		# Returns why thinking should stop before taking another step, or None to keep going
+		if num_steps >= MAX_THOUGHT_STEPS:
+			return "max_steps"
+		if thinking_tokens >= THINKING_TOKEN_BUDGET:
+			return "token_budget"
+		if deadline is not None and time.perf_counter() + (self.step_latency or 0.0) > deadline:
+			return "deadline"
+		return None
 	
 	def can_reflect(self):
 		"""Determines whether the AI should reflect on its memories and gain insights."""
 		return (
 			self.memory_system.importance_counter >= 10
-			and (datetime.now() - self.last_reflection).total_seconds() > 6 * 3600
+			and (clock.now() - self.last_reflection).total_seconds() > 6 * 3600
 			and len(self.memory_system.get_short_term_memories()) >= 5
 		)
 		
@@ -61,32 +150,43 @@ class ThoughtSystem:
 			return_json=True
 		)["questions"]
 
-		for question in questions:
+		# Every question is embedded and searched for in one batch, then the insights are generated concurrently
+		short_term = self.memory_system.get_short_term_memories()
+		long_term = self.memory_system.retrieve_long_term_many(questions, 12)
+		futures = [
+			_reflection_executor.submit(self._generate_insights, question, short_term + memories)
+			for question, memories in zip(questions, long_term)
+		]
+		all_insights = []
+		for question, future in zip(questions, futures):
+			insights = future.result()
 			print(f"Reflecting on '{question}'")
-			relevant_memories = (
-				self.memory_system.get_short_term_memories()
-				+ self.memory_system.retrieve_long_term(question, 12)
-			)
-			memories_str = "\n".join(mem.format_memory() for mem in relevant_memories)
-			insight_prompt = REFLECT_GEN_INSIGHTS.format(
-				memories=memories_str,
-				question=question
-			)
-			messages = [
-				{"role":"system", "content":self.config.system_prompt},
-				{"role":"user", "content":insight_prompt}
-			]
-			insights = self.model.generate(
-				messages,
-				temperature=0.1,
-				return_json=True
-			)["insights"]
 			print("Insights gained:")
 			for insight in insights:
-				self.memory_system.remember(f"I gained an insight after reflection: {insight}", is_insight=True)
 				print("- " + insight)
+			all_insights.extend(insights)
+		self.memory_system.remember_many(
+			[f"I gained an insight after reflection: {insight}" for insight in all_insights],
+			is_insight=True
+		)
 		self.memory_system.reset_importance()
-		self.last_reflection = datetime.now()
+		self.last_reflection = clock.now()
+
+	def _generate_insights(self, question, relevant_memories):
+		memories_str = "\n".join(mem.format_memory() for mem in relevant_memories)
+		insight_prompt = REFLECT_GEN_INSIGHTS.format(
+			memories=memories_str,
+			question=question
+		)
+		messages = [
+			{"role":"system", "content":self.config.system_prompt},
+			{"role":"user", "content":insight_prompt}
+		]
+		return self.model.generate(
+			messages,
+			temperature=0.1,
+			return_json=True
+		)["insights"]
 
 	def _check_and_fix_thought_output(self, data):
 		data = data.copy()
@@ -111,66 +211,34 @@ class ThoughtSystem:
 		data.setdefault("relationship_change", {"friendliness": 0.0, "dominance": 0.0})
 		return data
 
-	def think(self, messages, memories, recalled_memories, last_message):
-		"""Generates the AI's internal thoughts and emotions"""
-		memories_str = format_memories_to_string(
-			memories,
-			"You don't have any memories of this user yet!"
-		)
-		
-		memory_emotion = Emotion()
-		if recalled_memories:
-			# Add emotion influence from recalled memories
-			total_weight = 0.0
-			for memory in recalled_memories:
-				weight = memory.get_recency_factor(True)
-				memory_emotion += memory.emotion * weight
-				total_weight += weight
-			memory_emotion /= total_weight
-			self.emotion_system.add_emotion(memory_emotion * 0.3)
-
-		content = messages[-1]["content"]
-
-		img_data = None
-		if isinstance(content, list):
-			assert len(content) == 2
-			assert content[0]["type"] == "text"
-			assert content[1]["type"] == "image_url"
-			text_content = content[0]["text"] + "\n\n((The user attached an image to this message - please see the attached image.))"
-			img_data = content[1]
-		else:
-			text_content = content
+	def think(self, context, deadline=None):
+		"""Generates the AI's internal thoughts and emotions, given the turn's TurnContext.
+		Extra thinking steps stop early if the next one is expected to finish after the deadline (a time.perf_counter value)."""
+		start = time.perf_counter()
+		memories_str = context.memories_str or "You don't have any memories of this user yet!"
+		self._add_memory_emotion(context)
 
-		beliefs = self.memory_system.get_beliefs()
-		if beliefs:
-			belief_str = "\n".join(f"- {belief}" for belief in beliefs)
-		else:
-			belief_str = "None"
+		text_content = context.user_text
+		img_data = context.image
+		if img_data:
+			text_content += "\n\n((The user attached an image to this message - please see the attached image.))"
 		
-		appraisal = self.emotion_system.appraisal(messages, memories, beliefs)
-		appraisal_str = ", ".join(
-			f"{emotion} (Intensity {round(intensity*100)}%)"
-			for emotion, intensity in appraisal
-			if intensity >= 0.1	
-		)
-		appraisal_hint = ""
-		if appraisal and appraisal_str:
-			appraisal_hint = f"[This event makes {self.config.name} feel: {appraisal_str}]"
+		appraisal = self.emotion_system.appraisal(context)
+		appraisal_hint = self._get_appraisal_hint(appraisal)
 		
-		last_interaction = time_since_last_message_string(last_message)
 		prompt = THOUGHT_PROMPT.format(
 			name=self.config.name,
 			user_input=text_content,
-			personality_summary=self.personality_system.get_summary(),
-			mood_long_desc=self.emotion_system.get_mood_long_description(),			
-			curr_date=datetime.now().strftime("%a, %m/%d/%Y"),
-			curr_time=datetime.now().strftime("%I:%M %p"),
+			personality_summary=context.personality_summary,
+			mood_long_desc=context.mood_long_desc,
+			curr_date=context.curr_date,
+			curr_time=context.curr_time,
 
-			mood_prompt=self.emotion_system.get_mood_prompt(),
+			mood_prompt=context.mood_prompt,
 			memories=memories_str,
-			relationship_str=self.relation_system.get_string(),
-			beliefs=belief_str,
-			last_interaction=last_interaction,
+			relationship_str=context.relationship_str,
+			beliefs=context.belief_str,
+			last_interaction=context.last_interaction,
 			appraisal_hint=appraisal_hint
 		)
 		prompt_content = prompt
@@ -183,22 +251,15 @@ class ThoughtSystem:
 		thought_history = [
 			{"role":"system", "content":self.config.system_prompt},
 			{"role":"user", "content":"[START OF PREVIOUS CHAT HISTORY]"},
-			*messages[:-1],
+			*context.messages[:-1],
 			{"role":"user", "content":"[END OF PREVIOUS CHAT HISTORY]"},
 			{"role":"user", "content":prompt_content}
 		]
 		
-		data = {}
-		for _ in range(5):
-			data = self.model.generate(
-				thought_history,
-				temperature=1.0,
-				return_json=True,
-				schema=THOUGHT_SCHEMA
-			)
-			
-			if data.get("thoughts", []):
-				break
+		step_start = time.perf_counter()
+		data = self._generate_thoughts(thought_history)
+		if self.step_latency is None:
+			self._record_step_latency(time.perf_counter() - step_start)
 
 		data = self._check_and_fix_thought_output(data)
 		thought_history.append({
@@ -214,15 +275,22 @@ class ThoughtSystem:
 		thoughts_query = " ".join(thought["content"] for thought in data["thoughts"])
 	
 		num_steps = 0
+		thinking_tokens = 0
+		stop_reason = "final_answer"
 		
 		# Let it continue thinking if necessary
 		while data["next_action"].lower() == "continue_thinking":
+			stop_reason = self._get_stop_reason(num_steps, deadline, thinking_tokens)
+			if stop_reason:
+				break
+			stop_reason = "final_answer"
 			num_steps += 1
+			step_start = time.perf_counter()
 			added_context = ""
-			relevant_memories = self.memory_system.long_term.retrieve(thoughts_query, MEMORY_RETRIEVAL_TOP_K)
+			relevant_memories = self.memory_system.retrieve_long_term(thoughts_query, MEMORY_RETRIEVAL_TOP_K)
 			if relevant_memories:
 				added_context = ADDED_CONTEXT_TEMPLATE.format(
-					"\n".join(mem.format_memory() for mem in memories)
+					memories="\n".join(mem.format_memory() for mem in relevant_memories)
 				)
 
 			thought_history.append({
@@ -240,6 +308,9 @@ class ThoughtSystem:
 				"role": "assistant",
 				"content": json.dumps(new_data, indent=4)
 			})
+			self._record_step_latency(time.perf_counter() - step_start)
+			# Roughly 4 characters per token
+			thinking_tokens += sum(len(msg["content"]) for msg in thought_history[-2:]) // 4
 			thoughts_query = " ".join(thought["content"] for thought in new_data["thoughts"])
 	
 			if self.show_thoughts:
@@ -250,9 +321,100 @@ class ThoughtSystem:
 			all_thoughts = data["thoughts"] + new_data["thoughts"]
 			data = new_data.copy()
 			data["thoughts"] = all_thoughts
-			if num_steps >= MAX_THOUGHT_STEPS:
-				break
 
+		self.last_thinking = {
+			"steps": num_steps,
+			"seconds": time.perf_counter() - start,
+			"stop_reason": stop_reason
+		}
+		if self.show_thoughts and stop_reason not in ("final_answer", "max_steps"):
+			print(f"(Stopped thinking early: {stop_reason.replace('_', ' ')})")
+		return self._apply_thought(data, appraisal, appraisal_hint)
+
+	def think_and_respond(self, context):
+		"""Generates the appraisal, thoughts, emotion and response to the user in a single call.
+		Used in low-latency mode, so there's no deeper thinking. The response is in the returned data's "response"."""
+		start = time.perf_counter()
+		self._add_memory_emotion(context)
+
+		text_content = context.user_text
+		img_data = context.image
+		if img_data:
+			text_content += "\n\n((The user attached an image to this message - please see the attached image.))"
+
+		prompt_content = FUSED_PROMPT.format(
+			name=self.config.name,
+			user_input=text_content,
+			personality_summary=context.personality_summary,
+			mood_long_desc=context.mood_long_desc,
+			curr_date=context.curr_date,
+			curr_time=context.curr_time,
+			mood_prompt=context.mood_prompt,
+			memories=context.memories_str or "You don't have any memories of this user yet!",
+			relationship_str=context.relationship_str,
+			beliefs=context.belief_str,
+			last_interaction=context.last_interaction
+		)
+		if img_data:
+			prompt_content = [
+				{"type":"text", "text":prompt_content},
+				img_data
+			]
+		history = [
+			{"role":"system", "content":self.config.system_prompt},
+			{"role":"user", "content":"[START OF PREVIOUS CHAT HISTORY]"},
+			*context.messages[:-1],
+			{"role":"user", "content":"[END OF PREVIOUS CHAT HISTORY]"},
+			{"role":"user", "content":prompt_content}
+		]
+		data = self._generate_thoughts(history, schema=FUSED_SCHEMA, required=("thoughts", "response"))
+		response = data.pop("response", "")
+		if not response:
+			raise ValueError("The fused output has no response, even after retrying")
+		try:
+			appraisal = self.emotion_system._emotions_from_appraisal(data.pop("appraisal"))  # pylint: disable=W0212
+		except (KeyError, TypeError):
+			appraisal = []
+		data = self._check_and_fix_thought_output(data)
+
+		if self.show_thoughts:
+			print("Thinking:")
+			for thought in data["thoughts"]:
+				print(Fore.magenta + thought['content'] + Style.reset)
+		self.last_thinking = {
+			"steps": 0,
+			"seconds": time.perf_counter() - start,
+			"stop_reason": "fused"
+		}
+		data = self._apply_thought(data, appraisal, self._get_appraisal_hint(appraisal))
+		data["response"] = response
+		return data
+
+	def _add_memory_emotion(self, context):
+		# Recalled memories bring back some of the emotion they were formed with
+		if not context.recalled_memories:
+			return
+		memory_emotion = Emotion()
+		total_weight = 0.0
+		for memory in context.recalled_memories:
+			weight = memory.get_recency_factor(True)
+			memory_emotion += memory.emotion * weight
+			total_weight += weight
+		memory_emotion /= total_weight
+		self.emotion_system.add_emotion(memory_emotion * 0.3)
+
+	def _get_appraisal_hint(self, appraisal):
+		appraisal_str = ", ".join(
+			f"{emotion} (Intensity {round(intensity*100)}%)"
+			for emotion, intensity in appraisal
+			if intensity >= 0.1	
+		)
+		if appraisal and appraisal_str:
+			return f"[This event makes {self.config.name} feel: {appraisal_str}]"
+		return ""
+
+	def _apply_thought(self, data, appraisal, appraisal_hint):
+		# Applies the appraised emotions and relationship change to the emotion and relationship systems
 		if not appraisal and data["emotion"] != "Neutral":
 			appraisal = [(data["emotion"], data["emotion_intensity"])]
 		
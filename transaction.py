@@ -0,0 +1,73 @@
+"""Undoes a failed turn's changes to the AI system, without deep-copying it."""
+
+from collections import deque
+
+
+class Transaction:
+	"""A snapshot of an AISystem's mutable state, taken before a turn.
+	State that stays small no matter how long the AI has been running is copied: scalars, the message buffer,
+	short-term memory, the active emotions and the mood recording. Long-term memory keeps an undo journal instead,
+	so memory contents and embeddings are never copied."""
+
+	def __init__(self, ai):
+		self.ai = ai
+		memory_system = ai.memory_system
+		emotion_system = ai.emotion_system
+		recorder = emotion_system.recorder
+		short_term = memory_system.short_term
+
+		# Attributes that are only ever reassigned, never changed in place
+		self.attributes = [
+			(obj, obj.__dict__.copy())
+			for obj in (ai, ai.relation_system, ai.thought_system, emotion_system, memory_system, recorder)
+		]
+		self.mood = emotion_system.mood.copy()
+		self.emotion_buffer = emotion_system.emotion_buffer.copy()
+		self.rings = [
+			(ring, ring.samples.copy(), ring.start, ring.count)
+			for ring in (recorder.recent, recorder.archive)
+		]
+		self.carry = recorder.carry.copy()
+		self.messages = list(ai.buffer.messages)
+		self.system_prompt = ai.buffer.system_prompt
+		self.short_term = [(mem, mem.strength, mem.last_accessed) for mem in short_term.memories]
+		self.belief_elapsed = memory_system.belief_system.elapsed
+		self.num_forgotten = memory_system.long_term.num_forgotten
+		memory_system.long_term.begin_journal()
+
+	def commit(self):
+		"""Keeps the changes made since the snapshot"""
+		self.ai.memory_system.long_term.end_journal()
+
+	def rollback(self):
+		"""Restores the AI system to how it was when the snapshot was taken"""
+		ai = self.ai
+		memory_system = ai.memory_system
+		emotion_system = ai.emotion_system
+		recorder = emotion_system.recorder
+
+		# Long-term memory goes first, since it restores memories that may also be in short-term memory
+		memory_system.long_term.rollback_journal()
+		memory_system.long_term.num_forgotten = self.num_forgotten
+		for obj, attributes in self.attributes:
+			obj.__dict__.clear()
+			obj.__dict__.update(attributes)
+		emotion_system.mood = self.mood
+		emotion_system.emotion_buffer[:] = self.emotion_buffer
+		for ring, samples, start, count in self.rings:
+			ring.samples[:] = samples
+			ring.start = start
+			ring.count = count
+		recorder.carry[:] = self.carry
+		ai.buffer.messages = deque(self.messages, maxlen=ai.buffer.max_messages)
+		ai.buffer.system_prompt = self.system_prompt
+
+		short_term = memory_system.short_term
+		short_term.clear_memories()
+		for mem, strength, last_accessed in self.short_term:
+			mem.strength = strength
+			mem.last_accessed = last_accessed
+			short_term.memories.append(mem)
+			short_term.time_index.add(mem)
+		with memory_system.belief_system.lock:
+			memory_system.belief_system.elapsed = self.belief_elapsed
@@ -0,0 +1,77 @@
+"""The context shared by the stages of a turn, so that each prompt string is only built once per turn."""
+
+import clock
+from utils import (
+	conversation_to_string,
+	format_memories_to_string,
+	time_since_last_message_string
+)
+
+
+class TurnContext:
+	"""An immutable snapshot of what a turn's appraisal, thought and response prompts are built from.
+	Mood and relationship are captured when the turn starts, but thinking changes them,
+	so the response stage uses a copy made with with_mood after thinking."""
+
+	def __init__(
+		self,
+		messages,
+		memories,
+		recalled_memories,
+		beliefs,
+		personality_summary,
+		mood_long_desc,
+		mood_prompt,
+		relationship_str,
+		last_message
+	):
+		now = clock.now()
+		content = messages[-1]["content"]
+		if isinstance(content, list):
+			assert len(content) == 2
+			assert content[0]["type"] == "text"
+			assert content[1]["type"] == "image_url"
+			user_text, image = content[0]["text"], content[1]
+		else:
+			user_text, image = content, None
+
+		values = {
+			"messages": tuple(messages),
+			"user_text": user_text,
+			"image": image,
+			"history_str": conversation_to_string(messages),
+			"memories": tuple(memories),
+			"recalled_memories": tuple(recalled_memories),
+			# Empty if there are no memories, since each prompt words that case differently
+			"memories_str": format_memories_to_string(memories),
+			"beliefs": tuple(beliefs),
+			"belief_str": "\n".join(f"- {belief}" for belief in beliefs) if beliefs else "None",
+			"personality_summary": personality_summary,
+			"mood_long_desc": mood_long_desc,
+			"mood_prompt": mood_prompt,
+			"relationship_str": relationship_str,
+			"last_interaction": time_since_last_message_string(last_message),
+			"curr_date": now.strftime("%a, %m/%d/%Y"),
+			"curr_time": now.strftime("%I:%M %p")
+		}
+		for name, value in values.items():
+			object.__setattr__(self, name, value)
+
+	def with_mood(self, mood_long_desc, mood_prompt, relationship_str):
+		"""Returns a copy of the context with the mood and relationship replaced"""
+		context = object.__new__(TurnContext)
+		values = {
+			**self.__dict__,
+			"mood_long_desc": mood_long_desc,
+			"mood_prompt": mood_prompt,
+			"relationship_str": relationship_str
+		}
+		for name, value in values.items():
+			object.__setattr__(context, name, value)
+		return context
+
+	def __setattr__(self, name, value):
+		raise AttributeError("TurnContext is immutable")
+
+	def __delattr__(self, name):
+		raise AttributeError("TurnContext is immutable")
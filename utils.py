@@ -3,12 +3,14 @@ import re
 import os
 import time
 import base64
-from datetime import datetime
 
 import requests
 
 from colored import Style
 
+import clock
+
+
 def clear_screen():
 	"""Clears the screen."""
 	os.system("cls" if os.name == "nt" else "clear")
@@ -182,7 +184,7 @@ def convert_img_schema_to_url(url):
 def time_since_last_message_string(timestamp):
 	if not timestamp:
 		return "never (this is the first interaction)"
-	delta_time = int((datetime.now() - timestamp).total_seconds())
+	delta_time = int((clock.now() - timestamp).total_seconds())
 	if delta_time < 60:
 		return "just now"
 	